@@ -0,0 +1,62 @@
+"""
+Cold startup time of the manager CLI.
+
+    python benchmarks/startup.py [runs]
+
+Each command runs in a fresh interpreter with the repository on the path,
+and the median wall time is reported, followed by the slowest imports of
+`import manager` as measured by `python -X importtime`.
+"""
+
+import os, sys, time, statistics, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    'python': 'pass',
+    'import manager': 'import manager',
+    'cli (no-op)': 'import manager; manager.cli(["--daemon=status"])',
+    'builder': 'import manager; manager.Builder',
+    'clients': 'import manager; manager.ArmaClient'
+}
+
+def run(code: str, *flags: str) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=ROOT, MANAGER_SOCKET=os.path.join(ROOT, '.benchmark.sock'))
+
+    return subprocess.run(
+        [sys.executable, *flags, '-c', code],
+        env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True
+    )
+
+def measure(code: str, runs: int) -> float:
+    times = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(code)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+def slowest_imports(code: str, count: int = 10) -> list:
+    rows = []
+
+    for line in run(code, '-X', 'importtime').stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line: continue
+
+        _, cumulative, name = line.split('|')
+        rows.append((int(cumulative), name.rstrip()))
+
+    return sorted(rows, reverse=True)[:count]
+
+def main(runs: int = 20) -> None:
+    for name, code in COMMANDS.items():
+        print('{0:<16} {1:>8.1f} ms'.format(name, measure(code, runs) * 1000))
+
+    print('\nSlowest imports of `import manager` (cumulative):')
+
+    for us, name in slowest_imports(COMMANDS['import manager']):
+        print('{0:>8.1f} ms  {1}'.format(us / 1000, name))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
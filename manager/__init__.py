@@ -1,6 +1,44 @@
 
-from .builder import *
-from .clients import *
-from .hashing import *
-from .progress import *
-from .main import *
\ No newline at end of file
+import sys, importlib
+
+# Public names and the submodule defining them. Submodules are imported the
+# first time one of their names is used, so e.g. `--run` never loads the
+# builder and a build never loads the clients.
+_EXPORTS = {
+    'builder': (
+        'Binarizer', 'PBOPacker', 'StreamingPBOPacker', 'BINARIZERS', 'STAGING_MODES',
+        'process_steps', 'Linker', 'BuilderOptions', 'Builder'
+    ),
+    'clients': ('Service', 'SteamCMD', 'ArmaClient', 'SteamBatch', 'install_services'),
+    'config': ('config',),
+    'hashing': (
+        'ALGORITHMS', 'MMAP_THRESHOLD', 'RACY_WINDOW_NS', 'hash_file', 'HashCache',
+        'hash_files', 'TreeDigest', 'hash_dir'
+    ),
+    'progress': ('print_progress', 'ProgressManager'),
+    'main': ('FLAG_CONVERTERS', 'parse_args', 'manage_caches', 'select_steps', 'main', 'daemon', 'cli')
+}
+
+_LOCATIONS = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = list(_LOCATIONS)
+
+def __getattr__(name: str):
+    if (module := _LOCATIONS.get(name)) is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    importlib.import_module(f'.{module}', __name__)
+
+    # Bind the names of every submodule loaded so far. Importing a submodule
+    # sets it as an attribute here, which would otherwise shadow the name of
+    # the same spelling (`main`, `config`) and keep it from reaching us.
+    for module, names in _EXPORTS.items():
+        if (loaded := sys.modules.get(f'{__name__}.{module}')) is None: continue
+
+        for i in names:
+            globals()[i] = getattr(loaded, i)
+
+    return globals()[name]
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
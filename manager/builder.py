@@ -1,19 +1,33 @@
 
-import os, re, abc, shutil, collections
+import os, abc, json, shutil, hashlib, collections.abc
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import (
     Type,
     Any,
+    Dict,
     List,
+    NamedTuple,
+    Tuple,
     Union
 )
 from pathlib import Path, PurePath
-from pboutil import PBOFile, pbo_files_add
-from .hashing import hash_dir, hash_file
+from .cache import BuildCache
+from .fsutil import COPY_STRATEGIES, copy_file, copy_tree, remove_path, replace, temp_sibling
+from .hashing import HashCache
+from .index import MissionIndex
+from .retention import RetentionPolicy, prune_async
+from .manifest import Manifest, ManifestDiff, ManifestEntry
+from . import pbo, profiling
 
 class Binarizer(abc.ABC):
-    def __init__(self, path: Path, out_path: Path) -> None:
+    """
+    Packs `path` into `out_path`. If `files` is given it maps each path inside
+    the output to the file it is read from, and takes precedence over `path`.
+    """
+    def __init__(self, path: Path, out_path: Path, files: Union[Dict[str, Path], None] = None) -> None:
         self.path = path
+        self.files = files
         
         """ if not out_path.is_file():
             raise Exception(f'Output {out_path} is not a file')
@@ -35,57 +49,177 @@ class PBOPacker(Binarizer):
     ext = '.pbo'
 
     def binarize(self) -> Path:
-        f = PBOFile.from_directory(self.path)
+        # pboutil is slow to import and only needed here
+        from pboutil import PBOFile
+
+        if self.files is None:
+            # from_directory() changes into the directory it packs
+            cwd = os.getcwd()
+
+            try:
+                f = PBOFile.from_directory(self.path)
+            finally:
+                os.chdir(cwd)
+        else:
+            f = PBOFile()
+
+            for name in sorted(self.files, key=lambda x: x.lower()):
+                f.add_file(name, self.files[name])
 
         f.to_file(self.out_path)
 
         return self.out_path
 
+class StreamingPBOPacker(Binarizer):
+    """
+    Writes the PBO in a single pass with bounded memory: headers are built
+    from stat data, file contents are streamed into the output and the SHA1
+    trailer is computed as it is written. Without compression the output is
+    byte-identical to `PBOPacker`.
+
+    `compress` enables LZSS compression, either for the text formats in
+    `pbo.COMPRESSIBLE` (True) or for a list of extensions, on `jobs` worker
+    processes. Entries that do not shrink are stored as is.
+
+    Given the `previous` artifact and the paths `changed` since it was
+    built, entries that did not change are copied from it rather than
+    re-read (and re-compressed) from the sources.
+    """
+    ext = '.pbo'
+    supports_delta = True
+
+    def __init__(self, path: Path, out_path: Path, files: Union[Dict[str, Path], None] = None,
+            compress: Union[bool, List[str]] = False, jobs: Union[int, None] = None,
+            previous: Union[Path, None] = None, changed: Union[List[str], None] = None) -> None:
+        super().__init__(path, out_path, files)
+
+        if compress is True:
+            compress = pbo.COMPRESSIBLE
+
+        self.compress = tuple(x.lower() for x in compress or ())
+        self.jobs = jobs
+        self.previous = previous
+        self.changed = changed
+        self.reused = 0
+
+    def _compressible(self, name: str) -> bool:
+        return bool(self.compress) and name.lower().endswith(self.compress)
+
+    def _write(self, tmp: Path, entries: List[pbo.Entry]) -> None:
+        if self.previous is not None and self.changed is not None and self.previous.is_file():
+            fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+
+            try:
+                self.reused = pbo.write_delta(
+                    fd, entries, self.previous, self.changed, self._compressible, self.jobs, self.out_path.parent
+                )
+            finally:
+                os.close(fd)
+
+            return
+
+        with open(tmp, 'wb') as fp:
+            writer = pbo.HashingWriter(fp)
+
+            if self.compress:
+                pbo.write_compressed(writer, entries, self._compressible, self.jobs, self.out_path.parent)
+            else:
+                pbo.write_stored(writer, entries)
+
+            writer.finish()
+
+    def binarize(self) -> Path:
+        files = self.files if self.files is not None else pbo.files_from_directory(self.path)
+        entries = pbo.sort_entries(files)
+        tmp = temp_sibling(self.out_path)
+
+        try:
+            self._write(tmp, entries)
+
+            os.replace(tmp, self.out_path)
+        except BaseException:
+            remove_path(tmp)
+
+            raise
+
+        return self.out_path
+
+def link_action(dest: Path, target: Path, symlink: bool = True) -> str:
+    """ What deploying `target` to `dest` would do: create, replace or nothing ('unchanged'). """
+    if not os.path.lexists(dest):
+        return 'create'
+
+    if symlink and os.path.islink(dest) and os.path.realpath(dest) == os.path.realpath(target):
+        return 'unchanged'
+
+    return 'replace'
+
 BINARIZERS = {
-    'pbopacker': PBOPacker
+    'pbopacker': PBOPacker,
+    'pbostream': StreamingPBOPacker
 }
 
-def process_steps(steps: list) -> None:
-    for step in steps:
-        type_ = step.pop('type').lower()
+# copy:   merge every include into tmp_dir, then pack tmp_dir
+# direct: pack straight from the sources using the resolved file map
+STAGING_MODES = ('copy', 'direct')
 
-        if type_ == 'build':
-            Builder(step).build()
-        elif type_ == 'link':
-            Linker(**step).run()
-        else:
-            raise Exception(f'Unknown type {type_}')
+def process_steps(steps: list, jobs: int = 1) -> list:
+    # Imported here as the scheduler depends on this module
+    from .scheduler import Scheduler
+
+    return Scheduler(steps, jobs).run()
 
 class Linker:
     def __init__(self, **opts) -> None:
         self.source = Path(opts.pop('source'))
         self.dest = opts.pop('dest')
         self.symlink = opts.pop('symlink', True)
+        self.copy = opts.pop('copy', 'copy')
+
+        if self.copy not in COPY_STRATEGIES:
+            raise Exception(f'Invalid copy strategy {self.copy}')
 
         if not isinstance(self.dest, (list, tuple)):
             self.dest = [self.dest]
 
         self.dest = [Path(x) for x in self.dest]
 
+    def plan(self) -> List[Tuple[Path, str]]:
+        """ The action `run()` would take for each destination, see `link_action()`. """
+        return [(x, link_action(x, self.source, self.symlink)) for x in self.dest]
+
     def run(self):
+        """
+        Deploy `source` to every destination. The new link or copy is
+        created next to the destination and renamed over it, so whatever
+        reads the destination sees either the old or the new tree, never a
+        missing or partial one.
+        """
         for i in self.dest:
-            try:
-                os.remove(i)
-            # Workaround because .exists() was returning False
-            # even though the file existed
-            except FileNotFoundError:
-                pass
-
             if not i.parent.exists():
                 os.makedirs(i.parent)
 
-            if self.symlink:
-                os.symlink(self.source, i)
-            else:
-                if self.source.is_dir():
-                    shutil.copytree(self.source, i)
-                else:
-                    shutil.copyfile(self.source, i)
+            tmp = temp_sibling(i)
+            remove_path(tmp)
+
+            with profiling.phase('link') as span:
+                try:
+                    if self.symlink:
+                        os.symlink(self.source, tmp)
+                    elif self.source.is_dir():
+                        copy_tree(self.source, tmp, self.copy)
+                    else:
+                        copy_file(self.source, tmp, self.copy)
+
+                    replace(tmp, i)
+                except BaseException:
+                    if os.path.lexists(tmp):
+                        remove_path(tmp)
+
+                    raise
+
+                if not self.symlink and profiling.enabled():
+                    span.bytes, span.files = profiling.tree_size(i) if i.is_dir() else (os.path.getsize(i), 1)
 
 class BuilderOptions:
     _default_output = {
@@ -94,6 +228,13 @@ class BuilderOptions:
         'tmp_dir': 'tmp',
         'missions_dir': 'missions',
         'filename': 'mission',
+        'staging': 'copy',
+        'binarizer_options': {},
+        'copy': 'copy',
+        'incremental': False,
+        'cache': None,
+        'hash_cache': None,
+        'retention': None,
         'links': []
     }
 
@@ -107,8 +248,14 @@ class BuilderOptions:
         if not 'source_dir' in self.opts:
             raise Exception('Missing source_dir')
 
-        self.source_dir = self._process_path(self.opts['source_dir'])
+        # Everything else is relative to source_dir, which itself is
+        # relative to the working directory
+        self.source_dir = Path(os.path.abspath(self._process_pure_path(self.opts['source_dir'])))
         self._paths = opts.get('include', [])
+        self.variants = opts.get('variants', {})
+
+        if isinstance(self.variants, list):
+            self.variants = {x: {} for x in self.variants}
 
         if self.output.get('should_binarize'):
             if bnzr := self.output.get('binarizer', ''):
@@ -122,6 +269,12 @@ class BuilderOptions:
             else:
                 raise Exception('Invalid binarizer')
 
+        if self.output['copy'] not in COPY_STRATEGIES:
+            raise Exception(f'Invalid copy strategy {self.output["copy"]}')
+
+        if self.output['staging'] not in STAGING_MODES:
+            raise Exception(f'Invalid staging mode {self.output["staging"]}')
+
     def _process_pure_path(self, path: Union[PurePath, List[str], str]):
         if isinstance(path, PurePath): return path
 
@@ -160,31 +313,140 @@ class BuilderOptions:
     def binarizer(self) -> Binarizer:
         return self.output['binarizer']
 
+    @property
+    def binarizer_options(self) -> dict:
+        return self.output['binarizer_options']
+
     @property
     def tmp_dir(self) -> Path:
         return self._process_path(self.output['tmp_dir'])
 
     @property
     def missions_dir(self) -> Path:
-        return self._process_path(self.output['dir'])
+        return self._process_path(self.output.get('dir', self.output['missions_dir']))
+
+    @property
+    def staging(self) -> str:
+        return self.output['staging']
+
+    @property
+    def copy(self) -> str:
+        return self.output['copy']
+
+    @property
+    def incremental(self) -> bool:
+        return self.output['incremental']
+
+    @property
+    def manifest_file(self) -> Path:
+        return self.missions_dir.joinpath(f'.{self.filename}.manifest.json')
+
+    @property
+    def staging_manifest_file(self) -> Path:
+        """ Describes what tmp_dir holds; kept next to it so it is never packed. """
+        return self.tmp_dir.with_name(f'.{self.tmp_dir.name}.manifest.json')
+
+    @property
+    def excluded_paths(self) -> List[Path]:
+        """ What the step writes, which is never a source even when under source_dir. """
+        paths = [self.tmp_dir, self.staging_manifest_file, self.missions_dir]
+
+        if (cache := self.output['cache']):
+            paths.append(self._process_path(cache['dir'] if isinstance(cache, dict) else cache))
+
+        if (file := self.output['hash_cache']):
+            paths.append(self._process_path(file))
+
+        return paths
+
+    @property
+    def cache(self) -> Union[BuildCache, None]:
+        cache = self.output['cache']
+
+        if not cache: return None
+
+        if not isinstance(cache, dict):
+            cache = {'dir': cache}
+
+        return BuildCache(self._process_path(cache['dir']), cache.get('max_size'), self.copy)
+
+    @property
+    def hash_cache(self) -> Union[HashCache, None]:
+        if not (file := self.output['hash_cache']): return None
+
+        return HashCache.shared(self._process_path(file))
+
+    @property
+    def retention(self) -> Union[RetentionPolicy, None]:
+        return RetentionPolicy.from_options(self.output['retention'])
+
+    @property
+    def fingerprint(self) -> dict:
+        """ Options that affect the content of the output, as opposed to its location. """
+        bnzr = self.binarizer if self.should_binarize else None
+
+        return {
+            'should_binarize': self.should_binarize,
+            'binarizer': bnzr and f'{bnzr.__module__}.{bnzr.__qualname__}',
+            'binarizer_options': bnzr and self.binarizer_options
+        }
+
+    def variant(self, name: str) -> 'BuilderOptions':
+        """
+        Options of a variant: its `include` entries are overlaid on the files
+        of this (base) step and its `output` overrides the base output,
+        except for links, which are not inherited.
+        """
+        variant = self.variants[name] or {}
+        output = {k: v for k, v in self.opts.get('output', {}).items() if k != 'links'}
+        output['filename'] = f'{self.filename}_{name}'
+        output.update(variant.get('output', {}))
+
+        opts = {k: v for k, v in self.opts.items() if k not in ('variants', 'variant_jobs')}
+        opts.update(include=variant.get('include', []), output=output)
+
+        return BuilderOptions(**opts)
+
+    @property
+    def variant_jobs(self) -> Union[int, None]:
+        return self.opts.get('variant_jobs')
+
+    @property
+    def has_includes(self) -> bool:
+        return bool(self._paths)
 
     @property
     def paths(self) -> List[Any]:
         if not self._paths: yield PurePath(), PurePath()
 
         for p in self._paths:
-            if isinstance(p, collections.Sequence) and not isinstance(p, str) and len(p) > 1:
+            if isinstance(p, collections.abc.Sequence) and not isinstance(p, str) and len(p) > 1:
                 src, dst = self._process_pure_path(p[0]), self._process_pure_path(p[1])
 
                 yield src, dst
             else:
                 yield self._process_pure_path(p), None
 
+class BuildEstimate(NamedTuple):
+    name: str
+    files: int
+    size: int
+    copy_size: int
+    pack_size: int
+    # Files added, changed or removed since the last build; None unless incremental
+    changed: Union[int, None]
+    # 'hit', 'miss', 'off', or 'unknown' when some hashes are not known yet
+    cache: str
+    output: Path
+    links: List[Tuple[Path, str]]
+
 # Possibly a user-defined class that sets instructions on how to compile the source files?
 # Option to pass custom packager (for example if you wanted to use a different PBO packer or ObfuSQF)
 class Builder:
     def __init__(self, 
-            opts: Union[dict, BuilderOptions]
+            opts: Union[dict, BuilderOptions],
+            base_files: Union[Dict[str, Path], None] = None,
+            hash_cache: Union[HashCache, None] = None
         ) -> None:
 
         if not isinstance(opts, BuilderOptions):
@@ -196,6 +458,19 @@ class Builder:
         self._is_built = False
 
         self._out_file = None
+        self._next_idx = None
+        self.index = MissionIndex(self.opts.missions_dir, self.opts.filename, self.opts.file_ext)
+        self.pruner = None
+        self.files = None
+        self.changes = None
+        self.manifest = None
+        self._previous = Manifest()
+        self.hash_cache = hash_cache or self.opts.hash_cache
+        self.variants = {}
+
+        # Already resolved files of a base step, which this builder's own
+        # includes are overlaid on (see BuilderOptions.variant)
+        self._base_files = base_files
 
     @property
     def out_file(self) -> Path:
@@ -211,21 +486,15 @@ class Builder:
 
     @property 
     def current_mission_idx(self) -> int:
-        highest = -1
-        for f in self.opts.missions_dir.glob(f'{self._mission_prefix}[0-9]*'):
-            if (match := re.match(re.compile(f'{self._mission_prefix}([0-9]+)'), f.name)):
-                num_parsed = int(match.group(1))
-
-                if num_parsed > highest:
-                    highest = num_parsed
-
-        return highest
+        return self.index.current
 
     @property
     def next_mission_idx(self) -> int:
-        idx = self.current_mission_idx
+        # Only stable once reserved at the start of the output phase
+        if self._next_idx is not None:
+            return self._next_idx
 
-        return idx + 1
+        return self.index.next
 
     @property
     def current_mission_name(self) -> str:
@@ -243,6 +512,18 @@ class Builder:
     def next_mission(self) -> str:
         return self.opts.missions_dir.joinpath(self._add_ext(self.next_mission_name))
 
+    @property
+    def built_mission(self) -> Path:
+        """
+        The artifact this builder wrote, which need not be the newest one
+        when other builders of the step commit in between; the current one
+        if the step was up to date.
+        """
+        if self._next_idx is not None:
+            return self.index.path(self._next_idx)
+
+        return self.current_mission
+
     def _add_ext(self, f: str) -> str:
         return f + self.opts.file_ext
 
@@ -255,9 +536,10 @@ class Builder:
 
     def _merge(self, src: Path, dst: Path) -> None:
         self._verify_dir(dst)
+        excluded = self.opts.excluded_paths
 
         for entry in os.scandir(src):
-            if Path(entry) == self.opts.tmp_dir: continue
+            if Path(entry) in excluded: continue
 
             name = entry.name
             src_joined, dst_joined = (x.joinpath(name) for x in (src, dst))
@@ -267,7 +549,7 @@ class Builder:
 
                 self._merge(src_joined, dst_joined)
             else:
-                shutil.copy(src_joined, dst_joined)
+                copy_file(src_joined, dst_joined, self.opts.copy)
 
     def _join_source(self, src_pure: Path, dst_pure: Path) -> None:
             # pylint: disable=unsubscriptable-object
@@ -292,9 +574,9 @@ class Builder:
 
                     self._merge(src, dst)
                 else:
-                    shutil.copytree(src, dst)
+                    copy_tree(src, dst, self.opts.copy)
             else:
-                shutil.copy(src, dst)
+                copy_file(src, dst, self.opts.copy)
 
     def _join_sources(self) -> None:
         self._verify_dir(self.opts.tmp_dir)
@@ -302,22 +584,400 @@ class Builder:
         for paths in self.opts.paths:
             self._join_source(*paths)
 
+    def _walk_source(self, src: Path, dst: PurePath, files: Dict[str, Path]) -> None:
+        excluded = self.opts.excluded_paths
+
+        for entry in os.scandir(src):
+            path = Path(entry)
+            if path in excluded: continue
+
+            if entry.is_dir():
+                self._walk_source(path, dst.joinpath(entry.name), files)
+            else:
+                files[dst.joinpath(entry.name).as_posix()] = path
+
+    def _resolve_sources(self) -> Dict[str, Path]:
+        """
+        Map every file that `_join_sources` would stage to its source file,
+        keyed by its path inside the staged tree. Later includes override
+        earlier ones, as with the directory merge.
+        """
+        if self._base_files is not None:
+            files = dict(self._base_files)
+            paths = self.opts.paths if self.opts.has_includes else []
+        else:
+            files = {}
+            paths = self.opts.paths
+
+        for src_pure, dst_pure in paths:
+            src = self.opts.source_dir.joinpath(src_pure)
+
+            if src.is_dir():
+                self._walk_source(src, PurePath(dst_pure or ''), files)
+            else:
+                files[PurePath(dst_pure or src.name).as_posix()] = src
+
+        return files
+
+    def _stage(self, root: Path, files: Dict[str, Path], changes: ManifestDiff) -> None:
+        for name in changes.removed:
+            dst = root.joinpath(name)
+
+            try:
+                os.remove(dst)
+            except FileNotFoundError:
+                pass
+
+            # Drop directories left empty so they do not end up in the output
+            parent = dst.parent
+            while parent != root and parent.exists() and not os.listdir(parent):
+                parent.rmdir()
+                parent = parent.parent
+
+        for name in changes.dirty:
+            dst = root.joinpath(name)
+
+            if not dst.parent.exists():
+                os.makedirs(dst.parent)
+
+            copy_file(files[name], dst, self.opts.copy)
+
+    def _diff_manifest(self, files: Dict[str, Path]) -> Union[Manifest, None]:
+        """
+        Diff the sources against the manifest of the previous build.
+        Returns None if the step is up to date.
+        """
+        previous = Manifest.load(self.opts.manifest_file)
+        manifest = self.manifest = Manifest.from_files(files, previous, self.hash_cache)
+        manifest.fingerprint = self.opts.fingerprint
+
+        # The output would differ even for the same files, so rebuild everything
+        if previous.fingerprint != manifest.fingerprint:
+            previous = Manifest()
+
+        self.changes = previous.diff(manifest)
+        self._previous = previous
+
+        if not self.changes and self.current_mission_idx >= 0:
+            return None
+
+        return manifest
+
+    def _stage_incremental(self, files: Dict[str, Path], manifest: Manifest) -> ManifestDiff:
+        """
+        Only re-stage what changed since tmp_dir was last staged. The diff is
+        taken against the manifest of tmp_dir itself rather than that of the
+        output, which may have been reset or describe another tree; without
+        one, tmp_dir is staged from scratch.
+        """
+        staged_file = self.opts.staging_manifest_file
+        staged = Manifest.load(staged_file)
+
+        if not staged.entries or not self.opts.tmp_dir.exists():
+            self._del_tmp()
+            staged = Manifest()
+
+        # Dropped while tmp_dir is patched, so an interrupted build starts over
+        remove_path(staged_file)
+
+        self._verify_dir(self.opts.tmp_dir)
+        changes = staged.diff(manifest)
+        self._stage(self.opts.tmp_dir, files, changes)
+
+        Manifest(manifest.entries).save(staged_file)
+
+        return changes
+
+    def _from_cache(self, cache: Union[BuildCache, None]) -> Union[Path, None]:
+        if cache is None: return None
+
+        if (hit := cache.get(self.cache_key, self.opts.file_ext)) is None:
+            return None
+
+        self._verify_dir(self.opts.missions_dir)
+
+        if hit.is_dir():
+            copy_tree(hit, self.next_mission, self.opts.copy)
+        else:
+            copy_file(hit, self.next_mission, self.opts.copy)
+
+        return self.next_mission
+
+    def _to_cache(self, cache: Union[BuildCache, None], out: Path) -> None:
+        if cache is not None:
+            cache.put(self.cache_key, out, self.opts.file_ext)
+
+    def _input_size(self) -> Tuple[int, int]:
+        if self.files is not None:
+            return sum(os.path.getsize(x) for x in self.files.values()), len(self.files)
+
+        return profiling.tree_size(self.opts.tmp_dir)
+
     def _binarize(self) -> None:
-        binarizer = self.opts.binarizer(self.opts.tmp_dir, self.next_mission)
+        cache = self.opts.cache
 
-        return binarizer.binarize()
+        with profiling.phase('cache_get'):
+            out = self._from_cache(cache)
+
+        if out is not None:
+            return out
+
+        options = dict(self.opts.binarizer_options)
+
+        # `changes` is only valid against the artifact the previous manifest
+        # describes, which need not be the newest one: a plain build does
+        # not update the manifest. Without it, everything is packed.
+        if getattr(self.opts.binarizer, 'supports_delta', False) and self.changes is not None \
+                and (base := self._previous.artifact_path()) is not None:
+            options.update(previous=base, changed=self.changes.dirty)
+
+        if self.opts.staging == 'direct':
+            binarizer = self.opts.binarizer(self.opts.source_dir, self.next_mission, files=self.files, **options)
+        else:
+            binarizer = self.opts.binarizer(self.opts.tmp_dir, self.next_mission, **options)
+
+        with profiling.phase('binarize') as span:
+            out = binarizer.binarize()
+
+            # Input bytes, so the throughput is that of packing the sources
+            if profiling.enabled():
+                span.bytes, span.files = self._input_size()
+
+        with profiling.phase('cache_put'):
+            self._to_cache(cache, out)
+
+        return out
 
     def _del_tmp(self) -> None:
         if self.opts.tmp_dir.exists(): shutil.rmtree(self.opts.tmp_dir)
 
-    def __hash__(self) -> Any:
-        raise NotImplementedError()
-        #return self.build()
+        remove_path(self.opts.staging_manifest_file)
+
+    @property
+    def cache_key(self) -> str:
+        """
+        Deterministic key of the build output: the staged tree (paths and
+        contents) plus the options that affect how it is packed.
+        """
+        if self.manifest is None:
+            self.manifest = Manifest.from_files(self.files or self._resolve_sources(), cache=self.hash_cache)
+
+        return self._manifest_key(self.manifest)
+
+    def _manifest_key(self, manifest: Manifest) -> str:
+        hsh = hashlib.sha1(manifest.digest().encode('ascii'))
+        hsh.update(json.dumps(self.opts.fingerprint, sort_keys=True).encode('utf-8'))
+
+        return hsh.hexdigest()
+
+    def __hash__(self) -> int:
+        return int(self.cache_key, 16)
+
+    def _stat_manifest(self, files: Dict[str, Path], stats: Dict[str, os.stat_result]) -> Manifest:
+        """
+        A manifest of `files` built from stat data only: hashes come from the
+        previous manifest or the hash cache, and are left empty when unknown.
+        """
+        previous = Manifest.load(self.opts.manifest_file).entries
+        entries = {}
+
+        for name, src in files.items():
+            stat, source = stats[name], os.fspath(src)
+            old = previous.get(name)
+
+            if old is not None and (old.source, old.size, old.mtime) == (source, stat.st_size, stat.st_mtime_ns):
+                digest = old.hash
+            elif self.hash_cache is not None:
+                digest = self.hash_cache.get(src, stat) or ''
+            else:
+                digest = ''
+
+            entries[name] = ManifestEntry(source, stat.st_size, stat.st_mtime_ns, digest)
+
+        return Manifest(entries, self.opts.fingerprint)
+
+    def estimate(self) -> List[BuildEstimate]:
+        """
+        What a build would do, using stat calls only: nothing is hashed,
+        copied or written. Files whose hash is not known from the previous
+        manifest or the hash cache count as changed, so the estimate errs on
+        the side of more work.
+        """
+        if self.opts.variants:
+            base = self._resolve_sources()
+
+            return [
+                x for name in self.opts.variants
+                    for x in Builder(self._variant_options(name), base_files=base, hash_cache=self.hash_cache).estimate()
+            ]
+
+        files = self._resolve_sources()
+        stats = {name: os.stat(src) for name, src in files.items()}
+        size = sum(x.st_size for x in stats.values())
+        manifest = self._stat_manifest(files, stats)
+        unknown = [x for x, v in manifest.entries.items() if not v.hash]
+
+        changed = None
+        dirty_size = size
+
+        if self.opts.incremental:
+            previous = Manifest.load(self.opts.manifest_file)
+
+            if previous.fingerprint != manifest.fingerprint:
+                previous = Manifest()
+
+            diff = previous.diff(manifest)
+            dirty = set(diff.dirty) | set(unknown)
+            changed = len(dirty) + len(diff.removed)
+            dirty_size = sum(stats[x].st_size for x in dirty)
+
+        up_to_date = changed == 0 and self.current_mission_idx >= 0
+        output = self.current_mission if up_to_date else self.next_mission
+
+        if self.opts.cache is None:
+            cache = 'off'
+        elif unknown:
+            cache = 'unknown'
+        else:
+            hit = self.opts.cache.has(self._manifest_key(manifest), self.opts.file_ext)
+            cache = 'hit' if hit else 'miss'
+
+        if up_to_date:
+            copy_size = pack_size = 0
+        elif cache == 'hit':
+            copy_size, pack_size = (size if not self.opts.should_binarize else 0), 0
+        else:
+            # Staging copies what changed into an existing tmp_dir, everything otherwise
+            if self.opts.staging == 'direct':
+                copy_size = 0 if self.opts.should_binarize else size
+            elif self.opts.incremental and self.opts.tmp_dir.exists() \
+                    and (staged := Manifest.load(self.opts.staging_manifest_file)).entries:
+                staged_dirty = set(staged.diff(manifest).dirty) | set(unknown)
+                copy_size = sum(stats[x].st_size for x in staged_dirty)
+            else:
+                copy_size = size
+
+            delta = getattr(self.opts.binarizer, 'supports_delta', False) and self.opts.incremental \
+                and previous.artifact_path() is not None
+
+            if not self.opts.should_binarize:
+                pack_size = 0
+            else:
+                pack_size = dirty_size if delta else size
+
+        links = []
+
+        if dests := self.opts.output['links']:
+            if isinstance(dests, dict):
+                symlink, dests = dests.get('symlink', True), dests['dest']
+            else:
+                symlink = True
+
+            for dest in (dests if isinstance(dests, (list, tuple)) else [dests]):
+                links.append((Path(dest), link_action(Path(dest), output, symlink)))
+
+        return [BuildEstimate(
+            self.opts.filename, len(files), size, copy_size, pack_size, changed, cache, output, links
+        )]
+
+    def _variant_options(self, name: str) -> BuilderOptions:
+        opts = self.opts.variant(name)
+        # Variants pack straight from the file map, whatever the base does
+        opts.output['staging'] = 'direct'
+
+        return opts
+
+    def _build_variants(self) -> Any:
+        """
+        Resolve (and, if needed, hash) the base files once, then pack every
+        variant from the base plus its overlay. Variants always pack straight
+        from the file map, and run on threads so they share the hash cache.
+        """
+        base = self._resolve_sources()
+        cache = self.hash_cache or HashCache()
+
+        if self.opts.incremental or self.opts.cache is not None:
+            Manifest.from_files(base, cache=cache)
+
+        for name in self.opts.variants:
+            self.variants[name] = Builder(self._variant_options(name), base_files=base, hash_cache=cache)
+
+        step = profiling.current_step()
+
+        def build(builder: Builder) -> Any:
+            with profiling.attributed_to(step):
+                return builder.build()
+
+        with ThreadPoolExecutor(self.opts.variant_jobs) as executor:
+            list(executor.map(build, self.variants.values()))
+
+        self._is_built = True
+
+        return self
+
+    def _link(self) -> List[Path]:
+        """ Deploy the built mission to the configured links. Returns their destinations. """
+        if not (links := self.opts.output['links']): return []
+
+        if isinstance(links, list):
+            links = {
+                'dest': links
+            }
+
+        # Config values are read-only
+        links = {**links, 'source': self.built_mission}
+        linker = Linker(**links)
+        linker.run()
+
+        return linker.dest
 
     def _build(self) -> Any:
-        self._del_tmp()
+        if self.opts.variants:
+            return self._build_variants()
+
+        direct = self.opts.staging == 'direct'
+
+        if direct or self.opts.incremental:
+            with profiling.phase('resolve_sources') as span:
+                self.files = self._resolve_sources()
+                span.files = len(self.files)
+
+        if self.opts.incremental:
+            with profiling.phase('diff_manifest') as span:
+                manifest = self._diff_manifest(self.files)
+                span.files = len(self.files)
+
+            print(f'{self.opts.filename}: {self.changes}')
+
+            if manifest is None:
+                # Links are cheap to redo, and may have been removed since
+                self._link()
+
+                if self.hash_cache is not None:
+                    self.hash_cache.save()
+
+                self._is_built = True
+
+                return self
+
+            if not direct:
+                with profiling.phase('stage_incremental') as span:
+                    staged = self._stage_incremental(self.files, manifest)
 
-        self._join_sources()
+                    if profiling.enabled():
+                        span.files = len(staged.dirty)
+                        span.bytes = sum(os.path.getsize(self.files[x]) for x in staged.dirty)
+        elif not direct:
+            with profiling.phase('del_tmp'):
+                self._del_tmp()
+
+            with profiling.phase('join_sources') as span:
+                self._join_sources()
+
+                if profiling.enabled():
+                    span.bytes, span.files = profiling.tree_size(self.opts.tmp_dir)
+
+        self._next_idx = self.index.reserve()
 
         if self.opts.should_binarize:
             self._binarize()
@@ -325,21 +985,44 @@ class Builder:
             if self.opts.missions_dir.is_file():
                 raise TypeError(f'Output directory is a file')
 
-            shutil.copytree(self.opts.tmp_dir, self.next_mission)
+            cache = self.opts.cache
+
+            with profiling.phase('cache_get'):
+                hit = self._from_cache(cache)
+
+            if hit is None:
+                with profiling.phase('copy_output') as span:
+                    if direct:
+                        self._stage(self.next_mission, self.files, ManifestDiff(list(self.files), [], []))
+                    else:
+                        copy_tree(self.opts.tmp_dir, self.next_mission, self.opts.copy)
+
+                    if profiling.enabled():
+                        span.bytes, span.files = self._input_size()
 
-        if links := self.opts.output['links']:
-            if isinstance(links, list):
-                links = {
-                    'dest': links
-                }
+                with profiling.phase('cache_put'):
+                    self._to_cache(cache, self.next_mission)
 
-            links['source'] = self.current_mission
-            linker = Linker(**links)
-            linker.run()
+        self.index.commit(self._next_idx)
 
-        self._del_tmp()
+        linked = self._link()
 
-        self.is_built = True
+        if (policy := self.opts.retention) is not None:
+            self.pruner = prune_async(self.index, policy, linked)
+
+        with profiling.phase('save'):
+            if self.hash_cache is not None:
+                self.hash_cache.save()
+
+            if self.opts.incremental:
+                # A copied staging tree is kept around for the next build to patch
+                manifest.record_artifact(self.built_mission).save(self.opts.manifest_file)
+
+        if not self.opts.incremental and not direct:
+            with profiling.phase('del_tmp'):
+                self._del_tmp()
+
+        self._is_built = True
 
         return self
 
@@ -347,4 +1030,7 @@ class Builder:
         if not self._is_built:
             self._build()
 
-        return self.current_mission
+        if self.variants:
+            return {k: v.built_mission for k, v in self.variants.items()}
+
+        return self.built_mission
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import os, re, time, shutil
+
+from pathlib import Path
+from typing import (
+    List,
+    NamedTuple,
+    Union
+)
+
+from .fsutil import copy_file, copy_tree
+
+_SIZE_UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+def parse_size(size: Union[int, str, None]) -> int:
+    """ Parse a size such as 512, '750M' or '10G' into bytes. """
+    if size is None: return 0
+    if isinstance(size, int): return size
+
+    match = re.fullmatch(r'\s*([0-9]+)\s*([kmgt]?)i?b?\s*', size.lower())
+
+    if match is None:
+        raise Exception(f'Invalid size {size}')
+
+    return int(match.group(1)) * _SIZE_UNITS[match.group(2)]
+
+class CacheEntry(NamedTuple):
+    key: str
+    path: Path
+    size: int
+    last_used: float
+
+class BuildCache:
+    """
+    Content-addressed store of build artifacts, one file per key.
+
+    Lookups bump the mtime of a marker file next to the artifact, which is
+    what eviction orders by (atime is unreliable on noatime/relatime
+    mounts). The artifact itself is left alone, as it may share its inode
+    with a build output. Writes go through a temporary file and a rename so
+    several processes can share a directory.
+    """
+    def __init__(self, path: Path, max_size: Union[int, str, None] = None, strategy: str = 'copy') -> None:
+        self.path = Path(path)
+        self.max_size = parse_size(max_size)
+        self.strategy = strategy
+
+    def _file(self, key: str, ext: str) -> Path:
+        return self.path.joinpath(key + ext)
+
+    def _marker(self, file: Path) -> Path:
+        return file.with_name(f'.{file.name}.used')
+
+    def _touch(self, file: Path) -> None:
+        with open(self._marker(file), 'a'):
+            pass
+
+        os.utime(self._marker(file))
+
+    def has(self, key: str, ext: str = '') -> bool:
+        """ Like `get()`, without marking the entry as used. """
+        return self._file(key, ext).exists()
+
+    def get(self, key: str, ext: str = '') -> Union[Path, None]:
+        file = self._file(key, ext)
+
+        if not file.exists(): return None
+
+        self._touch(file)
+
+        return file
+
+    def put(self, key: str, file: Path, ext: str = '') -> Path:
+        if not self.path.exists():
+            os.makedirs(self.path)
+
+        dst = self._file(key, ext)
+        tmp = dst.with_name(f'.{dst.name}.{os.getpid()}.tmp')
+
+        # Unbinarized outputs may be hardlinks to the sources, which are
+        # edited in place; an entry must not change along with them
+        strategy = 'reflink' if self.strategy == 'hardlink' else self.strategy
+
+        if Path(file).is_dir():
+            copy_tree(file, tmp, strategy)
+
+            if dst.exists():
+                shutil.rmtree(tmp)
+            else:
+                os.rename(tmp, dst)
+        else:
+            copy_file(file, tmp, strategy)
+            os.replace(tmp, dst)
+
+        self._touch(dst)
+
+        if self.max_size:
+            self.prune(keep=[dst])
+
+        return dst
+
+    def entries(self) -> List[CacheEntry]:
+        """ All cached artifacts, least recently used first. """
+        if not self.path.exists(): return []
+
+        entries = []
+
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.'): continue
+
+            stat = entry.stat()
+            size = stat.st_size
+
+            if entry.is_dir():
+                size = sum(
+                    os.path.getsize(os.path.join(root, f))
+                        for root, _, files in os.walk(entry.path) for f in files
+                )
+
+            try:
+                last_used = os.stat(self._marker(Path(entry.path))).st_mtime
+            except FileNotFoundError:
+                last_used = stat.st_mtime
+
+            key = entry.name.split('.', 1)[0]
+            entries.append(CacheEntry(key, Path(entry.path), size, last_used))
+
+        return sorted(entries, key=lambda x: x.last_used)
+
+    @property
+    def size(self) -> int:
+        return sum(x.size for x in self.entries())
+
+    def prune(self, max_size: Union[int, str, None] = None,
+            max_age: Union[float, None] = None, keep: List[Path] = []) -> List[CacheEntry]:
+        """
+        Evict least recently used entries until the cache fits in `max_size`
+        bytes (defaults to the configured size) and drop anything unused for
+        longer than `max_age` seconds. Returns the evicted entries.
+        """
+        max_size = self.max_size if max_size is None else parse_size(max_size)
+        entries = self.entries()
+        total = sum(x.size for x in entries)
+        now = time.time()
+        removed = []
+
+        for entry in entries:
+            if entry.path in keep: continue
+
+            expired = max_age is not None and now - entry.last_used > max_age
+
+            if not expired and (not max_size or total <= max_size):
+                continue
+
+            self._remove(entry)
+
+            total -= entry.size
+            removed.append(entry)
+
+        return removed
+
+    def clear(self) -> List[CacheEntry]:
+        entries = self.entries()
+
+        for entry in entries:
+            self._remove(entry)
+
+        return entries
+
+    def _remove(self, entry: CacheEntry) -> None:
+        if entry.path.is_dir():
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+        try:
+            os.remove(self._marker(entry.path))
+        except FileNotFoundError:
+            pass
@@ -1,13 +1,16 @@
 
 from __future__ import annotations
 
-import io, os, abc, time, shutil, signal, requests, platform, zipfile, tarfile, subprocess
+import os, re, abc, json, time, shutil, signal, fnmatch, platform, subprocess
 
 from pathlib import (
     Path,
     PurePath
 )
 from typing import (
+    Callable,
+    Dict,
+    NamedTuple,
     Sequence,
     Union,
     Type,
@@ -16,6 +19,9 @@ from typing import (
 )
 
 from .config import config
+from .download import download
+from .fsutil import remove_path, replace, temp_sibling
+from .manifest import Manifest
 
 from .const import (
     IS_LINUX,
@@ -25,6 +31,27 @@ from .const import (
     ARMA_STEAM_ID
 )
 
+# Written into the SteamCMD directory, records which archive it came from
+INSTALL_MARKER = '.manager-install.json'
+
+# State the manager keeps inside an install, left out of its manifest
+INSTALL_MARKER_PREFIX = '.manager-'
+
+# Paths inside the server install (fnmatch patterns, posix separators) that
+# are written by us or the server rather than Steam: deployed missions,
+# profiles and logs, keys and configs. Left out of the install manifest, so
+# writing them is not mistaken for a damaged install. See `install_exclude`.
+INSTALL_EXCLUDE = (
+    'mpmissions/*', 'profiles/*', 'keys/*', '*.cfg', '*.rpt', '*.log', '*.mdmp', '*.bidmp'
+)
+
+def vdf_value(text: str, key: str) -> Union[str, None]:
+    """ First value of `key` in Valve KeyValues text, e.g. an .acf app manifest. """
+    if (match := re.search(r'"{0}"\s+"([^"]*)"'.format(re.escape(key)), text)) is None:
+        return None
+
+    return match.group(1)
+
 class Service(abc.ABC):
     path: Path = Path()
 
@@ -54,24 +81,52 @@ class Service(abc.ABC):
 class SteamCMD(Service):
     name = 'steamcmd'
 
-    def __init__(self, path: Path, login: list = []) -> SteamCMD:
+    def __init__(self, path: Path, login: list = [], url: Union[str, None] = None,
+            sha256: Union[str, None] = None, archive_cache: Union[Path, None] = None,
+            executable: Union[Path, None] = None) -> SteamCMD:
         self.path = path
         self.args = []
 
+        # Runs this instead of the installed steamcmd, e.g. a fake in tests
+        self._executable = executable
+
         if not isinstance(self.path, Path):
             self.path = Path(self.path)
 
-        if not self.path.is_dir():
+        if not self.path.is_dir() and self.path.suffix:
             self.path = self.path.parent
+
+        # Where the bootstrap archive comes from (overridable, e.g. for a
+        # local mirror) and where it is kept between installs
+        self.url = url or STEAM_DL_URL + STEAM_DL_FILE
+        self.sha256 = sha256
+        self.archive_cache = Path(archive_cache) if archive_cache else self.path.parent.joinpath('.steamcmd-cache')
         
         if login:
             self.login(*login) # pylint: disable=no-value-for-parameter
 
-    def run(self):
+    def run(self, capture: bool = False, echo: bool = True) -> Union[str, None]:
+        """ Run the queued commands; with `capture`, the output is also returned. """
         callable_ = self.subprocess_callable
 
         # For some reason installing using steamcmd does not return 0
-        subprocess.run(callable_)
+        if not capture:
+            subprocess.run(callable_)
+
+            return None
+
+        lines = []
+
+        with subprocess.Popen(
+                callable_, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True, errors='replace') as proc:
+            for line in proc.stdout:
+                lines.append(line)
+
+                if echo:
+                    print(line, end='', flush=True)
+
+        return ''.join(lines)
 
     def add(self, *commands: Sequence[Union[str, list]]) -> SteamCMD:
         for command in commands:
@@ -97,6 +152,9 @@ class SteamCMD(Service):
 
     @property
     def executable(self) -> Path:
+        if self._executable is not None:
+            return Path(self._executable)
+
         return self.path.joinpath(STEAM_EXECUTABLE)
 
     @property
@@ -109,23 +167,56 @@ class SteamCMD(Service):
     def _format_arg(self, arg: str) -> str:
         return '+' + arg
 
-    def install(self) -> SteamCMD:
-        self.uninstall()
-
-        url = STEAM_DL_URL + STEAM_DL_FILE
-        r = requests.get(url, stream=True)
+    @property
+    def installed_from(self) -> Union[str, None]:
+        """ Checksum of the archive the current install was extracted from. """
+        try:
+            with open(self.path.joinpath(INSTALL_MARKER)) as fp:
+                return json.load(fp).get('sha256')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def install(self, force: bool = False) -> SteamCMD:
+        """
+        Download the bootstrap archive (resuming and revalidating a cached
+        copy, see `download()`) and extract it. Nothing is done when the
+        install already comes from an identical archive. The archive is read
+        from disk and extracted next to the install, which is then swapped
+        in, so a failed install leaves the previous one untouched.
+        """
+        import tarfile, zipfile
+
+        archive = download(self.url, self.archive_cache.joinpath(STEAM_DL_FILE), self.sha256)
+
+        if not force and self.installed_from == archive.sha256:
+            return self
+
+        if not self.path.parent.exists():
+            os.makedirs(self.path.parent)
+
+        tmp = temp_sibling(self.path, 'install')
+        remove_path(tmp)
+
+        try:
+            if zipfile.is_zipfile(archive.path):
+                with zipfile.ZipFile(archive.path) as fp:
+                    fp.extractall(tmp)
+            else:
+                with tarfile.open(archive.path) as fp:
+                    # Rejects absolute paths and links out of the tree where supported
+                    if hasattr(tarfile, 'data_filter'):
+                        fp.extractall(tmp, filter='data')
+                    else:
+                        fp.extractall(tmp)
 
-        if not self.path.exists():
-            os.makedirs(self.path)
+            with open(tmp.joinpath(INSTALL_MARKER), 'w') as fp:
+                json.dump({'url': self.url, 'sha256': archive.sha256}, fp)
 
-        mem_file = io.BytesIO(r.content)
+            replace(tmp, self.path)
+        except BaseException:
+            remove_path(tmp)
 
-        if IS_LINUX:
-            file_obj = tarfile.TarFile.open(fileobj=mem_file)
-        else:
-            file_obj = zipfile.ZipFile(mem_file)
-        
-        file_obj.extractall(self.path)
+            raise
 
         return self
 
@@ -147,7 +238,13 @@ class ArmaClient(Service):
         if not isinstance(self.path, Path):
             self.path = Path(self.path)
 
-        self._mods = self._opts.pop('mods', {})
+        self._mods = dict(self._opts.pop('mods', {}))
+        self._instances = list(self._opts.pop('instances', []))
+        self._install_exclude = tuple(self._opts.pop('install_exclude', INSTALL_EXCLUDE))
+        self._restart = dict(self._opts.pop('restart', {}))
+
+        # Runs this instead of arma3server, e.g. a dummy in tests
+        self._executable = self._opts.pop('executable', None)
         self._loaded_mods = []
         self.cli_args = []
 
@@ -170,20 +267,92 @@ class ArmaClient(Service):
 
         self.popen = subprocess.Popen(self.subprocess_callable, cwd=self.path)
 
-        self.popen.wait()
+        try:
+            self.popen.wait()
+        finally:
+            self.kill()
 
-    def kill(self):
-        if self.popen is not None or self.popen.poll() is None:
-            self.popen.terminate()
+    def kill(self, timeout: float = 30):
+        """ Terminate the server if it is running, killing it after `timeout` seconds. """
+        if (popen := self.popen) is None: return
 
         self.popen = None
 
+        if popen.poll() is None:
+            popen.terminate()
+
+            try:
+                popen.wait(timeout)
+            except subprocess.TimeoutExpired:
+                popen.kill()
+                popen.wait()
+
+    def instances(self) -> list:
+        """
+        Launch specs of the configured `instances`. Each one is a server, or
+        a headless client with `"headless": true`, named by `name`, pinned
+        to `cpus` and started after `delay` seconds; its remaining keys are
+        arguments overriding those of the client. Servers without a port
+        get one 10 above the previous server's, headless clients connect to
+        the first server, and every instance gets a profile of its own.
+        """
+        from .supervisor import InstanceSpec
+
+        args = dict(x if type(x) in [list, tuple] else (x, None) for x in self.cli_args)
+        instances = [dict(x) for x in self._instances or [{}]]
+        port = int(args.get('port', 2302))
+        ports = {}
+
+        # Server ports first, as headless clients may be listed before the server
+        for idx, instance in enumerate(instances):
+            if not instance.get('headless', False):
+                ports[idx] = int(instance.get('port', port))
+                port = ports[idx] + 10
+
+        first_port = next(iter(ports.values()), port)
+        specs = []
+
+        for idx, instance in enumerate(instances):
+            name = instance.pop('name', f'instance{idx}')
+            cpus = instance.pop('cpus', None)
+            delay = instance.pop('delay', 0)
+
+            if instance.pop('headless', False):
+                extra = {'client': None, 'connect': '127.0.0.1', 'port': first_port}
+            else:
+                extra = {'port': ports[idx]}
+
+            extra['profiles'] = os.fspath(self.path.joinpath('profiles', name))
+            extra['name'] = name
+            extra.update(instance)
+
+            specs.append(InstanceSpec(
+                name, self.command([k if v is None or v is True else [k, v] for k, v in extra.items() if v is not False]),
+                self.path, cpus, delay
+            ))
+
+        return specs
+
+    def supervise(self) -> None:
+        """ Run every instance from this process until they exit or a signal stops them, see `Supervisor`. """
+        import asyncio
+
+        from .supervisor import Supervisor
+
+        supervisor = Supervisor(self.instances(), **self._restart)
+
+        asyncio.run(supervisor.run())
+
     def add_arg(self, *args: Sequence[Union[str, Tuple[str, str]]]):
         self.cli_args.extend(args)
 
         return self
 
     def load_mods(self) -> None:
+        self._loaded_mods = []
+
+        if not self._mods: return
+
         path = self.mods['dir']
 
         for i in self.mods.get('load', []):
@@ -191,9 +360,25 @@ class ArmaClient(Service):
                 self._loaded_mods.append(str(i))
             elif (joined := path.joinpath(i)).exists():
                 self._loaded_mods.append(str(joined))
+            # Synced workshop mods may have been lowercased
+            elif (joined := path.joinpath(str(i).lower())).exists():
+                self._loaded_mods.append(str(joined))
             else:
                 raise Exception('Invalid mod ' + i)
 
+    def sync_mods(self, force: bool = False) -> list:
+        """
+        Bring the workshop mods (`mods.workshop`, name -> item id) up to
+        date, see `ModSync`. Returns the mods that were downloaded.
+        """
+        from .mods import ModSync
+
+        mods = self.mods
+
+        return ModSync(
+            mods['dir'], mods.get('workshop', {}), mods.get('jobs', 2), mods.get('lowercase', IS_LINUX)
+        ).sync(force)
+
     @property
     def mods(self) -> dict:
         if self._mods: return self._mods
@@ -202,6 +387,9 @@ class ArmaClient(Service):
 
     @property
     def executable(self) -> str:
+        if self._executable is not None:
+            return Path(self._executable)
+
         if IS_LINUX:
             exe = 'arma3server'
         elif self._opts.get('64bit', False):
@@ -211,17 +399,30 @@ class ArmaClient(Service):
 
         return self.path.joinpath(exe)
 
-    @property
-    def subprocess_callable(self) -> Sequence[str]:
+    @staticmethod
+    def _arg_name(arg: Union[str, Sequence[str]]) -> str:
+        return arg[0] if type(arg) in [list, tuple] else arg
+
+    def command(self, args: Sequence[Union[str, Sequence[str]]] = ()) -> List[str]:
+        """ Command line with the client's arguments, those in `args` replacing any of the same name. """
         self.load_mods()
 
+        cli_args = list(self.cli_args)
+
         if self._loaded_mods:
-            self.add_arg(['mod', ';'.join(self._loaded_mods) + ';'])
+            cli_args.append(['mod', ';'.join(self._loaded_mods) + ';'])
+
+        replaced = {self._arg_name(x) for x in args}
+        cli_args = [x for x in cli_args if self._arg_name(x) not in replaced] + list(args)
 
-        return [self.executable] + [
-            self._format_arg(*x) if type(x) in [list, tuple] else self._format_arg(x) for x in self.cli_args
+        return [os.fspath(self.executable)] + [
+            self._format_arg(*x) if type(x) in [list, tuple] else self._format_arg(x) for x in cli_args
         ]
 
+    @property
+    def subprocess_callable(self) -> Sequence[str]:
+        return self.command()
+
     def _format_arg(self, name: str, value: Union[str, None] = None) -> str:
         name = '-' + name
 
@@ -230,18 +431,231 @@ class ArmaClient(Service):
 
         return name
 
-    def install(self) -> ArmaClient:
-        cmd_arr = ['app_update', ARMA_STEAM_ID, 'validate']
+    @property
+    def installed_build_id(self) -> Union[str, None]:
+        try:
+            with open(self.path.joinpath('steamapps', f'appmanifest_{ARMA_STEAM_ID}.acf')) as fp:
+                return vdf_value(fp.read(), 'buildid')
+        except FileNotFoundError:
+            return None
 
-        steamcmd = SteamCMD(**config.services['steamcmd'])
+    def _is_excluded(self, name: str) -> bool:
+        return any(fnmatch.fnmatchcase(name, x) for x in self._install_exclude)
 
-        if self.path is not None:
-            if self.path.exists():
-                if not self.path.is_dir():
-                    raise TypeError(self.path + ' is a file')
+    def _installed_files(self) -> Dict[str, Path]:
+        """
+        Files of the install, without Steam's own state, our state, the mods
+        or anything matching `install_exclude`.
+        """
+        excluded = {self.path.joinpath('steamapps'), self._mods.get('dir')}
+        files = {}
 
-            steamcmd.add(['force_install_dir', os.fspath(self.path.absolute())])
+        for root, dirs, names in os.walk(self.path):
+            root = Path(root)
+            dirs[:] = [x for x in dirs if root.joinpath(x) not in excluded]
 
-        steamcmd.add(cmd_arr).run()
+            for name in names:
+                if name.startswith(INSTALL_MARKER_PREFIX): continue
+
+                path = root.joinpath(name)
+                rel = path.relative_to(self.path).as_posix()
+
+                if not self._is_excluded(rel):
+                    files[rel] = path
+
+        return files
+
+    @property
+    def _state_file(self) -> Path:
+        return self.path.joinpath(INSTALL_MARKER_PREFIX + 'manifest.json')
+
+    def queue(self, batch: SteamBatch, validate: Union[bool, None] = None) -> None:
+        """
+        Add the install or update to `batch`. With `validate` left as None,
+        SteamCMD is only asked to validate the install when files recorded
+        after the last install have changed. A plain app_update of a current
+        install only compares build ids, so it is cheaper to queue it into
+        the batch than to ask for the latest build in a session of its own.
+        """
+        if self.path.exists() and not self.path.is_dir():
+            raise TypeError(f'{self.path} is a file')
+
+        recorded = Manifest.load(self._state_file)
+
+        # Recorded before the exclusions changed
+        recorded.entries = {k: v for k, v in recorded.entries.items() if not self._is_excluded(k)}
+
+        if validate is None:
+            if not recorded.entries:
+                # Nothing recorded: validate an existing install once
+                validate = self.installed_build_id is not None
+            # Files added since (logs, configs, ...) are not drift
+            elif (drift := recorded.verify()):
+                print(f'{self.name}: local changes ({drift}), validating')
+                validate = True
+            else:
+                validate = False
+
+        batch.app_update(ARMA_STEAM_ID, self.path, validate, lambda _: self._record_install(recorded))
+
+    def _record_install(self, previous: Manifest) -> None:
+        if self.installed_build_id is None: return
+
+        manifest = Manifest.from_files(self._installed_files(), previous)
+        manifest.fingerprint = {'buildid': self.installed_build_id}
+        manifest.save(self._state_file)
+
+    def install(self, validate: Union[bool, None] = None) -> ArmaClient:
+        """ Install or update the server in a SteamCMD session of its own, see `queue()`. """
+        batch = SteamBatch()
+        self.queue(batch, validate)
+        batch.run().check()
+
+        return self
+
+class SteamItem(NamedTuple):
+    # 'app' or 'workshop'
+    kind: str
+    app_id: str
+    item_id: Union[str, None]
+    install_dir: Union[Path, None]
+    validate: bool
+    # Called with the item's result once it succeeded
+    done: Union[Callable[[ItemResult], None], None] = None
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return (self.kind, self.item_id if self.kind == 'workshop' else self.app_id)
+
+    def __str__(self) -> str:
+        if self.kind == 'workshop':
+            return f'workshop item {self.item_id}'
+
+        return f'app {self.app_id}'
+
+class ItemResult(NamedTuple):
+    item: SteamItem
+    ok: bool
+    message: str
+
+class BatchResult(List[ItemResult]):
+    @property
+    def failed(self) -> List[ItemResult]:
+        return [x for x in self if not x.ok]
+
+    def check(self) -> BatchResult:
+        if (failed := self.failed):
+            raise Exception('SteamCMD failed for ' + ', '.join(f'{x.item} ({x.message})' for x in failed))
+
+        return self
+
+# SteamCMD's summary lines, e.g.
+#   Success! App '233780' fully installed.
+#   Error! App '233780' state is 0x202 after update job.
+#   Success. Downloaded item 450814997 to "..." (1234 bytes)
+#   ERROR! Download item 450814997 failed (Timeout).
+_APP_RESULT = re.compile(r"^\s*(Success|Error|ERROR)!.*?\b[Aa]pp '(\d+)'\s*(.*)$", re.M)
+_WORKSHOP_RESULT = re.compile(r'^\s*(Success|Error|ERROR)[.!] Download(?:ed)? item (\d+)\s*(.*)$', re.M)
+
+def parse_results(output: str) -> Dict[Tuple[str, str], List[Tuple[bool, str]]]:
+    """
+    Outcomes reported for each app and workshop item in `output`, in order,
+    since the same app can be updated into several directories.
+    """
+    results = {}
+
+    for kind, pattern in (('app', _APP_RESULT), ('workshop', _WORKSHOP_RESULT)):
+        for match in pattern.finditer(output):
+            outcome = (match.group(1) == 'Success', match.group(3).strip())
+            results.setdefault((kind, match.group(2)), []).append(outcome)
+
+    return results
+
+class SteamBatch:
+    """
+    Collects app_update and workshop_download_item commands, from any
+    number of services, and runs them in one SteamCMD session: one process,
+    one login. The outcome of each item is read from SteamCMD's output.
+    """
+    def __init__(self, steamcmd: Union[dict, None] = None) -> None:
+        self._steamcmd = steamcmd
+        self.items: List[SteamItem] = []
+
+    def steamcmd(self) -> SteamCMD:
+        return SteamCMD(**(self._steamcmd if self._steamcmd is not None else config.services['steamcmd']))
+
+    def app_update(self, app_id: str, install_dir: Union[Path, None] = None, validate: bool = False,
+            done: Union[Callable[[ItemResult], None], None] = None) -> SteamBatch:
+        self.items.append(SteamItem('app', app_id, None, install_dir, validate, done))
 
         return self
+
+    def workshop_download_item(self, app_id: str, item_id: str, install_dir: Union[Path, None] = None,
+            validate: bool = False, done: Union[Callable[[ItemResult], None], None] = None) -> SteamBatch:
+        self.items.append(SteamItem('workshop', app_id, str(item_id), install_dir, validate, done))
+
+        return self
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def commands(self) -> List[list]:
+        commands, install_dir = [], None
+
+        for item in self.items:
+            # force_install_dir applies to every command after it
+            if item.install_dir is not None and item.install_dir != install_dir:
+                install_dir = item.install_dir
+                commands.append(['force_install_dir', os.fspath(Path(install_dir).absolute())])
+
+            if item.kind == 'workshop':
+                cmd = ['workshop_download_item', item.app_id, item.item_id]
+            else:
+                cmd = ['app_update', item.app_id]
+
+            commands.append(cmd + (['validate'] if item.validate else []))
+
+        return commands
+
+    def run(self, echo: bool = True) -> BatchResult:
+        results = BatchResult()
+
+        if not self.items: return results
+
+        output = self.steamcmd().add(*self.commands()).run(capture=True, echo=echo)
+        reported = parse_results(output)
+
+        for item in self.items:
+            if (outcomes := reported.get(item.key)):
+                ok, message = outcomes.pop(0)
+            else:
+                ok, message = False, 'no result in the SteamCMD output'
+            results.append(result := ItemResult(item, ok, message))
+
+            if ok and item.done is not None:
+                item.done(result)
+
+        self.items = []
+
+        return results
+
+def install_services(names: Sequence[str], validate: Union[bool, None] = None) -> BatchResult:
+    """
+    Install the services `names`. SteamCMD itself is installed first; every
+    service that can, then queues its work into a single SteamCMD session.
+    """
+    services = [Service.create(x, **config.services[x]) for x in names]
+    batch = SteamBatch()
+
+    for service in sorted(services, key=lambda x: not isinstance(x, SteamCMD)):
+        if hasattr(service, 'queue'):
+            service.queue(batch, validate)
+        else:
+            service.install()
+
+    results = batch.run()
+
+    for result in results:
+        print('{0}: {1} {2}'.format(result.item, 'ok' if result.ok else 'failed', result.message))
+
+    return results.check()
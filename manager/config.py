@@ -1,33 +1,72 @@
-
-
-import os, re, json
+import os, re, json, signal
 from pathlib import Path
 
-from dotenv import load_dotenv
-
 from typing import (
-    Any
+    Any,
+    Dict,
+    Tuple
 )
 
+# ${NAME}, not preceded by a backslash
+_VAR_PATTERN = re.compile(r'\$(?<!\\)\{(?<!\\)([a-zA-Z0-9_]*)\}(?<!\\)')
+
+def _immutable(*args):
+    raise TypeError('Config values are read-only, copy them first')
+
+class FrozenDict(dict):
+    """ A dict that cannot be modified in place; `dict(x)` gives a mutable copy. """
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+class FrozenList(list):
+    """ A list that cannot be modified in place; `list(x)` gives a mutable copy. """
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = clear = sort = reverse = _immutable
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
 class _Config:
+    """
+    Values of the JSON config, with ${VAR} replaced by environment variables.
+
+    Each top-level key is resolved the first time it is used and then kept,
+    along with the environment variables it referenced, so later accesses
+    return the same read-only value. A key is resolved again only if one of
+    those variables changed; the whole snapshot is dropped when the file is
+    set again after changing on disk, or on `reload()`.
+    """
     def __init__(self):
         self._loaded = False
         self._data = {}
-        
+        self._stamp = None
+        self._resolved: Dict[str, Tuple[Any, Dict[str, str]]] = {}
+
         self.file = None
 
     def _load(self):
         if self.file is None:
             raise Exception('File has not been set')
 
+        self._stamp = self._file_stamp()
+
         with open(self.file) as fp:
             self._data = json.load(fp)
 
-
+        self._resolved = {}
         self._loaded = True
-        
+
+        return self._apply_env()
+
+    def _apply_env(self):
+        """ Set the variables of the `env` section (a .env file and/or vars). """
         if env := getattr(self, 'env', None):
             if f := env.get('file', None):
+                from dotenv import load_dotenv
+
                 load_dotenv(dotenv_path=f)
             if vars_ := env.get('vars', {}):
                 for k, v in vars_.items():
@@ -39,38 +78,81 @@ class _Config:
         if not self._loaded:
             self._load()
 
-        val = self._data.get(*args)
+        key = args[0]
 
-        a = self._handle_value(val)
-        return a
+        if (cached := self._resolved.get(key)) is not None:
+            value, used = cached
 
-    def _handle_string(self, value: str) -> str:
+            if all(os.environ.get(k) == v for k, v in used.items()):
+                return value
+
+        used = {}
+        value = self._handle_value(self._data.get(*args), used)
+        self._resolved[key] = (value, used)
+
+        return value
+
+    def _handle_string(self, value: str, used: Dict[str, str]) -> str:
         def repl(match: re.Match) -> str:
             name = match.group(1)
 
             try:
-                return str(os.environ[name])
+                used[name] = os.environ[name]
             except KeyError:
                 raise KeyError(f'Environment variable {name} not set')
 
-        return re.sub(r'\$(?<!\\)\{(?<!\\)([a-zA-Z0-9_]*)\}(?<!\\)', repl, value)
+            return str(used[name])
+
+        return _VAR_PATTERN.sub(repl, value)
 
-    def _handle_value(self, value: Any):
+    def _handle_value(self, value: Any, used: Dict[str, str]):
         if isinstance(value, str):
-            return self._handle_string(value)
+            return self._handle_string(value, used) if '$' in value else value
         elif isinstance(value, dict):
-            return {k: self._handle_value(v) for k, v in value.items()}
+            return FrozenDict({k: self._handle_value(v, used) for k, v in value.items()})
         elif isinstance(value, (list, tuple)):
-            return [self._handle_value(x) for x in value]
+            return FrozenList([self._handle_value(x, used) for x in value])
         else:
             return value
-    
+
+    def environment(self, key: str) -> Dict[str, str]:
+        """ The environment variables `key` refers to, with their current values. """
+        self._get(key)
+
+        return dict(self._resolved[key][1])
+
     def __getattr__(self, *args) -> Any:
         return self._get(*args)
 
+    def _file_stamp(self):
+        stat = os.stat(self.file)
+
+        return (stat.st_mtime_ns, stat.st_size)
+
     def set_json_file(self, file: Path):
+        # A long-running process sets the same file again on every request,
+        # possibly with another environment (see daemon), so only the
+        # variables of the env section are applied again
+        if self._loaded and file == self.file and self._stamp == self._file_stamp():
+            self._apply_env()
+            return
+
         self.file = file
 
         self._load()
 
+    def reload(self):
+        """ Re-read the file and drop every resolved value. """
+        return self._load()
+
+    def reload_on_signal(self, signum: int = getattr(signal, 'SIGHUP', None)):
+        """ Reload whenever `signum` (SIGHUP by default) is received. """
+        if signum is None: return
+
+        def handler(*_):
+            if self.file is not None:
+                self.reload()
+
+        signal.signal(signum, handler)
+
 config = _Config()
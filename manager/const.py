@@ -4,9 +4,12 @@ import platform
 IS_LINUX = platform.system() == 'Linux'
 
 DEFAULT_CONFIG_FILE = 'example.githide.json'
+DAEMON_SOCKET = '.manager.sock'
 
 STEAM_DL_URL = 'https://steamcdn-a.akamaihd.net/client/installer/'
 STEAM_DL_FILE = 'steamcmd_linux.tar.gz' if IS_LINUX else 'steamcmd.zip'
 STEAM_EXECUTABLE = 'steamcmd.sh' if IS_LINUX else 'steamcmd.exe'
 
-ARMA_STEAM_ID = '233780'
\ No newline at end of file
+ARMA_STEAM_ID = '233780'
+# Workshop items of Arma 3 are published under the game, not the server
+ARMA_WORKSHOP_ID = '107410'
\ No newline at end of file
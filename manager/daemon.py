@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import io, os, json, time, signal, socket, threading, contextlib, socketserver
+
+from pathlib import Path
+from typing import Union
+
+from .config import config
+from .const import DAEMON_SOCKET
+
+# Only these options are run by the daemon, anything else (running the
+# server, installing, watching, loading a .env) stays in the calling process
+FORWARDED_OPTIONS = {'build', 'cache', 'jobs', 'config'}
+
+def socket_path() -> Path:
+    return Path(os.environ.get('MANAGER_SOCKET', DAEMON_SOCKET))
+
+class _Output(io.TextIOBase):
+    """ Sends what a request prints back to the client, one JSON line per write. """
+    def __init__(self, wfile) -> None:
+        self.wfile = wfile
+        self.closed_ = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if text and not self.closed_:
+            try:
+                self.wfile.write(json.dumps({'out': text}).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except OSError:
+                # The client went away, finish the build regardless
+                self.closed_ = True
+
+        return len(text)
+
+@contextlib.contextmanager
+def _environment(env: Union[dict, None]):
+    """ Replace the environment with `env` for the duration of a request. """
+    if env is None:
+        yield
+        return
+
+    saved = dict(os.environ)
+    os.environ.clear()
+    os.environ.update(env)
+
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+
+        reply = self.server.manager.handle(request, self.wfile)
+
+        try:
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        except OSError:
+            pass
+
+        # Only once replied, as the daemon exits as soon as it has shut down
+        if request.get('command') == 'stop':
+            self.server.manager.stop()
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class Daemon:
+    """
+    Keeps a manager process around so that repeated builds skip the imports,
+    the config parsing and the hash cache loading. Requests come in as JSON
+    lines over a Unix socket: `main` runs `main(args, options)` with its
+    output streamed back, `status` and `stop` do what they say. Builds are
+    run one at a time, and only for clients in the daemon's working
+    directory, as relative paths in the config are resolved against it.
+    Each build runs with the client's environment, which ${VAR} in the
+    config and the cached build plan are checked against.
+    """
+    def __init__(self, path: Union[Path, None] = None) -> None:
+        self.path = Path(path or socket_path())
+        self.cwd = os.getcwd()
+        self.started = time.time()
+        self.requests = 0
+        self.last = None
+
+        self._lock = threading.Lock()
+        self._server = None
+
+    def status(self) -> dict:
+        return {
+            'pid': os.getpid(),
+            'cwd': self.cwd,
+            'uptime': time.time() - self.started,
+            'requests': self.requests,
+            'busy': self._lock.locked(),
+            'last': self.last
+        }
+
+    def stop(self) -> None:
+        # shutdown() waits for serve_forever(), so it cannot run on a handler thread
+        threading.Thread(target=self._server.shutdown).start()
+
+    def _main(self, request: dict, wfile) -> dict:
+        from .main import main
+
+        if request.get('cwd') != self.cwd:
+            return {'status': 'refused', 'error': f'Daemon runs in {self.cwd}'}
+
+        with self._lock:
+            self.requests += 1
+            start = time.perf_counter()
+
+            try:
+                with _environment(request.get('env')), contextlib.redirect_stdout(_Output(wfile)):
+                    main(request.get('args', []), request.get('options', {}))
+            except Exception as e:
+                reply = {'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+            else:
+                reply = {'status': 'ok'}
+
+            reply['elapsed'] = time.perf_counter() - start
+            self.last = {'options': request.get('options', {}), **reply}
+
+        return reply
+
+    def handle(self, request: dict, wfile) -> dict:
+        command = request.get('command')
+
+        if command == 'main':
+            return self._main(request, wfile)
+        elif command == 'status':
+            return {'status': 'ok', **self.status()}
+        elif command == 'stop':
+            return {'status': 'ok'}
+
+        return {'status': 'error', 'error': f'Unknown command {command}'}
+
+    def serve(self) -> None:
+        if request(self.path, {'command': 'status'}) is not None:
+            raise Exception(f'A daemon is already listening on {self.path}')
+
+        # Left behind by a daemon that did not exit cleanly
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+        self._server = _Server(os.fspath(self.path), _Handler)
+        self._server.manager = self
+
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        config.reload_on_signal()
+        print(f'Listening on {self.path} (pid {os.getpid()})')
+
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+
+def request(path: Path, message: dict, output=None) -> Union[dict, None]:
+    """
+    Send `message` to the daemon at `path`, printing forwarded output to
+    `output` (stdout by default). Returns the final reply, or None if no
+    daemon is listening.
+    """
+    if not hasattr(socket, 'AF_UNIX'): return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(os.fspath(path))
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+
+        return None
+
+    with sock, sock.makefile('rwb') as fp:
+        fp.write(json.dumps(message).encode('utf-8') + b'\n')
+        fp.flush()
+
+        for line in fp:
+            reply = json.loads(line)
+
+            if 'out' in reply:
+                print(reply['out'], end='', file=output, flush=True)
+            else:
+                return reply
+
+    raise Exception('Daemon closed the connection')
+
+def forward(args: list, options: dict, path: Union[Path, None] = None) -> bool:
+    """
+    Run a command through the daemon if it can be. Returns False when it
+    has to run locally instead; errors raised by the daemon are re-raised.
+    """
+    if not set(options) <= FORWARDED_OPTIONS or not {'build', 'cache'} & set(options):
+        return False
+
+    reply = request(path or socket_path(), {
+        'command': 'main',
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+        'args': args,
+        'options': options
+    })
+
+    if reply is None or reply['status'] == 'refused':
+        return False
+
+    if reply['status'] != 'ok':
+        raise Exception(reply['error'])
+
+    return True
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import os, json, hashlib
+
+from pathlib import Path
+from typing import (
+    NamedTuple,
+    Union
+)
+
+from .fsutil import write_json
+
+# Small enough that little is lost when a transfer breaks off mid-chunk
+CHUNK_SIZE = 64 * 1024
+
+class Download(NamedTuple):
+    path: Path
+    sha256: str
+    # False when the local copy was still current and nothing was fetched
+    changed: bool
+
+def _meta_file(dest: Path) -> Path:
+    return dest.with_name(dest.name + '.json')
+
+def _load_meta(dest: Path) -> dict:
+    try:
+        with open(_meta_file(dest)) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _save_meta(dest: Path, meta: dict) -> None:
+    write_json(_meta_file(dest), meta)
+
+def _hash_file(file: Path) -> 'hashlib._Hash':
+    hsh = hashlib.sha256()
+
+    with open(file, 'rb') as fp:
+        while (chunk := fp.read(CHUNK_SIZE)):
+            hsh.update(chunk)
+
+    return hsh
+
+def download(url: str, dest: Path, sha256: Union[str, None] = None, timeout: float = 60) -> Download:
+    """
+    Fetch `url` to `dest`, streaming to disk in chunks.
+
+    The response's ETag / Last-Modified are kept next to `dest`, so a later
+    call sends a conditional request and skips the transfer when upstream
+    has not changed. An interrupted transfer leaves `<dest>.part` behind,
+    which the next call resumes with a Range request (guarded by If-Range,
+    so a changed upstream restarts from scratch). With `sha256` given, the
+    result is verified and a mismatching download is discarded.
+    """
+    import requests
+
+    dest = Path(dest)
+    part = dest.with_name(dest.name + '.part')
+    meta = _load_meta(dest)
+    headers = {}
+    offset = 0
+
+    if not dest.parent.exists():
+        os.makedirs(dest.parent)
+
+    validator = meta.get('etag') or meta.get('last_modified')
+    same = meta.get('url') == url and validator is not None
+
+    if same and meta.get('complete') and dest.exists() and sha256 in (None, meta.get('sha256')):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    elif same and not meta.get('complete') and part.exists() and part.stat().st_size:
+        offset = part.stat().st_size
+        headers['Range'] = f'bytes={offset}-'
+        headers['If-Range'] = validator
+
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        if r.status_code == 304:
+            return Download(dest, meta['sha256'], False)
+
+        r.raise_for_status()
+
+        if r.status_code == 206 and r.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+            hsh = _hash_file(part)
+            mode = 'ab'
+        else:
+            hsh = hashlib.sha256()
+            mode, offset = 'wb', 0
+
+        length = r.headers.get('Content-Length')
+        size = offset + int(length) if length is not None else None
+
+        # Recorded before streaming, so an interrupted transfer can resume
+        meta = {
+            'url': url,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'size': size,
+            'complete': False
+        }
+        _save_meta(dest, meta)
+
+        with open(part, mode) as fp:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                fp.write(chunk)
+                hsh.update(chunk)
+
+    if size is not None and part.stat().st_size != size:
+        raise Exception(f'Incomplete download of {url}: {part.stat().st_size} of {size} bytes')
+
+    digest = hsh.hexdigest()
+
+    if sha256 is not None and digest != sha256.lower():
+        os.remove(part)
+
+        raise Exception(f'Checksum mismatch for {url}: expected {sha256}, got {digest}')
+
+    os.replace(part, dest)
+    _save_meta(dest, {**meta, 'size': dest.stat().st_size, 'sha256': digest, 'complete': True})
+
+    return Download(dest, digest, True)
@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import os, json, errno, ctypes, shutil, functools, threading
+
+from pathlib import Path
+from typing import Any, Union
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .const import IS_LINUX
+
+# reflink:  copy-on-write clone, shares blocks until either side is written
+# hardlink: same inode, only valid while neither side is modified in place
+# copy:     full byte copy
+COPY_STRATEGIES = ('reflink', 'hardlink', 'copy')
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# linux/fs.h, for renameat2()
+AT_FDCWD = -100
+RENAME_EXCHANGE = 1 << 1
+
+# Errors meaning "not supported here" rather than a real failure
+_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOTTY, errno.EOPNOTSUPP, errno.EMLINK}
+
+# (strategy, src device, dst device) combinations known to fail, so the
+# fallback is taken straight away for the remaining files
+_unsupported = set()
+
+def reflink(src: Path, dst: Path) -> None:
+    if fcntl is None or not IS_LINUX:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform')
+
+    with open(src, 'rb') as src_fp, open(dst, 'wb') as dst_fp:
+        fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+
+    shutil.copymode(src, dst)
+
+def _device(path: Path) -> int:
+    return os.stat(path).st_dev
+
+def copy_file(src: Path, dst: Union[Path, str], strategy: str = 'copy') -> str:
+    """
+    Place `src` at `dst` (replacing it) using `strategy`, falling back to a
+    plain copy where the filesystem does not support it. Returns the
+    strategy that was used.
+    """
+    if strategy not in COPY_STRATEGIES:
+        raise Exception(f'Invalid copy strategy {strategy}')
+
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    # Never write through an existing file, it may be linked to a source
+    try:
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+
+    if strategy != 'copy':
+        key = (strategy, _device(src), _device(os.path.dirname(dst) or '.'))
+
+        if key not in _unsupported:
+            try:
+                if strategy == 'reflink':
+                    reflink(src, dst)
+                else:
+                    os.link(src, dst)
+
+                return strategy
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED: raise
+
+                _unsupported.add(key)
+
+                try:
+                    os.remove(dst)
+                except FileNotFoundError:
+                    pass
+
+    shutil.copy(src, dst)
+
+    return 'copy'
+
+def copy_tree(src: Path, dst: Path, strategy: str = 'copy') -> Path:
+    return shutil.copytree(src, dst, copy_function=functools.partial(copy_file, strategy=strategy))
+
+def temp_sibling(path: Path, tag: str = 'tmp') -> Path:
+    """ A hidden path next to `path`, on the same filesystem so it can be renamed over it. """
+    path = Path(path)
+
+    return path.with_name(f'.{path.name}.{os.getpid()}.{tag}')
+
+def write_json(file: Path, data: Any, **kwargs) -> None:
+    """
+    Write `data` as JSON to a temporary file next to `file` and rename it
+    over `file`, so readers see either the old or the new contents. The
+    temporary name is unique per process and thread.
+    """
+    tmp = temp_sibling(file, f'{threading.get_ident()}.tmp')
+
+    try:
+        with open(tmp, 'w') as fp:
+            json.dump(data, fp, **kwargs)
+
+        os.replace(tmp, file)
+    except BaseException:
+        remove_path(tmp)
+
+        raise
+
+def remove_path(path: Path) -> None:
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def exchange(a: Path, b: Path) -> bool:
+    """
+    Atomically swap two existing paths of any type with renameat2(). Returns
+    False where that is not supported (non-Linux, old kernel or libc, or a
+    filesystem without RENAME_EXCHANGE).
+    """
+    if not IS_LINUX: return False
+
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except AttributeError:
+        return False
+
+    res = renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE)
+
+    if res != 0:
+        err = ctypes.get_errno()
+
+        if err in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+            return False
+
+        raise OSError(err, os.strerror(err), os.fspath(b))
+
+    return True
+
+def replace(src: Path, dst: Path) -> None:
+    """
+    Move `src` over `dst` so that `dst` is never missing or half written.
+    Files and symlinks are renamed over the destination. A rename cannot
+    replace a directory, so directories are swapped with `exchange()` where
+    possible, and otherwise moved aside just before `src` is renamed into
+    place. The old tree is removed once the new one is visible.
+    """
+    dst_is_dir = os.path.isdir(dst) and not os.path.islink(dst)
+    src_is_dir = os.path.isdir(src) and not os.path.islink(src)
+
+    if not os.path.lexists(dst) or not (dst_is_dir or src_is_dir):
+        os.replace(src, dst)
+
+        return
+
+    if exchange(src, dst):
+        old = src
+    else:
+        old = temp_sibling(dst, 'old')
+
+        os.rename(dst, old)
+        os.rename(src, dst)
+
+    remove_path(old)
@@ -1,13 +1,38 @@
-
 import os
+import mmap
+import json
+import time
 import hashlib
+import threading
 from pathlib import Path
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Union
+
+from .fsutil import write_json
+
+ALGORITHMS = ('sha1', 'sha256', 'blake2b')
+
+# Files at least this large are hashed through a memory map in one update()
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+# Entries modified this recently are not cached, as a write within the same
+# mtime tick would otherwise go unnoticed
+RACY_WINDOW_NS = 2 * 10 ** 9
 
-def hash_file(file: Path, buf_size: int = 16 * 1024) -> Any:
-    hsh = hashlib.sha1()
+# Process-wide HashCache instances by file, see HashCache.shared()
+_shared = {}
+_shared_lock = threading.Lock()
+
+def hash_file(file: Path, buf_size: int = 1024 * 1024, algorithm: str = 'sha1') -> Any:
+    hsh = hashlib.new(algorithm)
 
     with open(file, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                hsh.update(mm)
+
+            return hsh
+
         while True:
             buf = fp.read(buf_size)
             if not buf: break
@@ -16,15 +41,257 @@ def hash_file(file: Path, buf_size: int = 16 * 1024) -> Any:
 
     return hsh
 
-def hash_dir(directory: Path) -> Any:
-    hsh = hashlib.sha1()
+class HashCache:
+    """
+    Persistent map of file digests, keyed by algorithm and path and
+    validated against (size, mtime_ns, inode), so unchanged files only cost
+    a stat. Safe to share between threads.
+    """
+    def __init__(self, file: Union[Path, None] = None) -> None:
+        self.file = file
+        self._entries = {}
+        self._dirty = False
+        self._stamp = None
+        self._lock = threading.Lock()
 
-    if not directory.exists(): return hsh
+        if self.file is not None:
+            self.load()
 
-    for root, _, files in os.walk(directory):
-        for f in files:
-            path = Path(root, f)
+    @classmethod
+    def shared(cls, file: Path) -> 'HashCache':
+        """
+        One instance per file for the whole process, so a long-running
+        process keeps its entries in memory. It is reloaded only if the file
+        has been written by someone else since it was last loaded or saved.
+        """
+        key = os.path.abspath(file)
 
-            hsh.update(hash_file(path).digest())
-    
-    return hsh
+        with _shared_lock:
+            if (cache := _shared.get(key)) is None:
+                cache = _shared[key] = cls(file)
+            elif not cache._dirty and cache._stamp != cache._file_stamp():
+                cache.load()
+
+        return cache
+
+    def _file_stamp(self) -> Union[tuple, None]:
+        try:
+            stat = os.stat(self.file)
+        except FileNotFoundError:
+            return None
+
+        return (stat.st_mtime_ns, stat.st_ino)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _key(self, path: Path, algorithm: str) -> str:
+        return algorithm + ':' + os.path.abspath(path)
+
+    def load(self) -> 'HashCache':
+        # Taken first, a write racing the read then causes another reload
+        stamp = self._file_stamp()
+
+        try:
+            with open(self.file) as fp:
+                entries = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            entries = {}
+
+        with self._lock:
+            self._entries = entries
+            self._dirty = False
+            self._stamp = stamp
+
+        return self
+
+    def save(self) -> 'HashCache':
+        if self.file is None or not self._dirty: return self
+
+        file = Path(self.file)
+
+        if not file.parent.exists():
+            os.makedirs(file.parent)
+
+        with self._lock:
+            write_json(file, self._entries)
+
+            self._dirty = False
+            self._stamp = self._file_stamp()
+
+        return self
+
+    def get(self, path: Path, stat: os.stat_result, algorithm: str = 'sha1') -> Union[str, None]:
+        entry = self._entries.get(self._key(path, algorithm))
+
+        if entry is None or entry[:3] != [stat.st_size, stat.st_mtime_ns, stat.st_ino]:
+            return None
+
+        return entry[3]
+
+    def set(self, path: Path, stat: os.stat_result, digest: str, algorithm: str = 'sha1') -> None:
+        if stat.st_mtime_ns >= time.time_ns() - RACY_WINDOW_NS: return
+
+        with self._lock:
+            self._entries[self._key(path, algorithm)] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, digest]
+            self._dirty = True
+
+def hash_files(
+        files: Iterable[Path],
+        algorithm: str = 'sha1',
+        cache: Union[HashCache, None] = None,
+        jobs: Union[int, None] = None
+    ) -> Dict[Path, str]:
+    """
+    Hex digests of `files`. Files missing from `cache` are read on a thread
+    pool; hashlib releases the GIL while hashing, so reads overlap.
+    """
+    digests, misses = {}, []
+
+    for f in files:
+        stat = os.stat(f)
+
+        if cache is not None and (digest := cache.get(f, stat, algorithm)) is not None:
+            digests[f] = digest
+        else:
+            misses.append((f, stat))
+
+    def hash_one(miss):
+        return hash_file(miss[0], algorithm=algorithm).hexdigest()
+
+    if len(misses) > 1 and jobs != 1:
+        with ThreadPoolExecutor(jobs) as executor:
+            hashed = list(executor.map(hash_one, misses))
+    else:
+        hashed = [hash_one(x) for x in misses]
+
+    for (f, stat), digest in zip(misses, hashed):
+        digests[f] = digest
+
+        if cache is not None:
+            cache.set(f, stat, digest, algorithm)
+
+    return digests
+
+class TreeDigest:
+    """
+    Merkle digest of a directory. Every directory is hashed from its entries
+    sorted by name, each entry contributing its type, name and digest, so
+    the result does not depend on the filesystem's listing order and
+    renames or moves change it. Subtree digests are kept, which lets `diff`
+    skip every subtree whose digest matches.
+    """
+    def __init__(self, algorithm: str, children: Dict[str, Union['TreeDigest', str]]) -> None:
+        self.algorithm = algorithm
+        self.children = children
+
+        hsh = hashlib.new(algorithm)
+
+        for name in sorted(children):
+            child = children[name]
+
+            if isinstance(child, TreeDigest):
+                hsh.update(b'd' + name.encode('utf-8') + b'\0' + child.digest())
+            else:
+                hsh.update(b'f' + name.encode('utf-8') + b'\0' + bytes.fromhex(child))
+
+        self._digest = hsh.digest()
+
+    def digest(self) -> bytes:
+        return self._digest
+
+    def hexdigest(self) -> str:
+        return self._digest.hex()
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, TreeDigest) and self._digest == other._digest
+
+    def __hash__(self) -> int:
+        return hash(self._digest)
+
+    def find(self, path: str) -> Union['TreeDigest', str, None]:
+        """ Subtree or file digest at the posix path `path`, relative to this tree. """
+        node = self
+
+        for part in filter(None, path.split('/')):
+            if not isinstance(node, TreeDigest): return None
+
+            node = node.children.get(part)
+
+        return node
+
+    def diff(self, other: 'TreeDigest', prefix: str = '') -> List[str]:
+        """
+        Paths that differ between the two trees. Added or removed directories
+        are reported as a whole rather than file by file.
+        """
+        if self.algorithm != other.algorithm:
+            raise Exception('Cannot compare trees hashed with different algorithms')
+
+        changed = []
+
+        for name in sorted(set(self.children) | set(other.children)):
+            a, b = self.children.get(name), other.children.get(name)
+            path = prefix + name
+
+            if isinstance(a, TreeDigest) and isinstance(b, TreeDigest):
+                if a != b:
+                    changed.extend(a.diff(b, path + '/'))
+            elif a != b:
+                changed.append(path)
+
+        return changed
+
+    def as_dict(self) -> dict:
+        return {
+            'algorithm': self.algorithm,
+            'children': {
+                k: v.as_dict()['children'] if isinstance(v, TreeDigest) else v
+                    for k, v in self.children.items()
+            }
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'TreeDigest':
+        algorithm = data['algorithm']
+
+        def build(children):
+            return cls(algorithm, {
+                k: build(v) if isinstance(v, dict) else v for k, v in children.items()
+            })
+
+        return build(data['children'])
+
+def _scan(directory: Path, files: List[Path]) -> dict:
+    tree = {}
+
+    for entry in os.scandir(directory):
+        path = Path(entry)
+
+        if entry.is_dir():
+            tree[entry.name] = _scan(path, files)
+        else:
+            tree[entry.name] = path
+            files.append(path)
+
+    return tree
+
+def hash_dir(
+        directory: Path,
+        algorithm: str = 'sha1',
+        cache: Union[HashCache, None] = None,
+        jobs: Union[int, None] = None
+    ) -> TreeDigest:
+    if algorithm not in ALGORITHMS:
+        raise Exception(f'Unsupported algorithm {algorithm}')
+
+    files = []
+    tree = _scan(directory, files) if directory.exists() else {}
+    digests = hash_files(files, algorithm, cache, jobs)
+
+    def build(node):
+        return TreeDigest(algorithm, {
+            k: build(v) if isinstance(v, dict) else digests[v] for k, v in node.items()
+        })
+
+    return build(tree)
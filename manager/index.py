@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import os, re, json, contextlib
+
+from pathlib import Path
+from typing import (
+    Iterator,
+    List
+)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from .fsutil import write_json
+
+@contextlib.contextmanager
+def file_lock(path: Path) -> Iterator[None]:
+    """ Exclusive advisory lock on `path`, held across processes. """
+    with open(path, 'a+') as fp:
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        else:
+            fp.seek(0)
+            msvcrt.locking(fp.fileno(), msvcrt.LK_LOCK, 1)
+
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+            else:
+                fp.seek(0)
+                msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+
+class MissionIndex:
+    """
+    Version numbers of a builder's outputs (`<name>_<N><ext>`), kept in a
+    small state file next to them instead of globbing the directory.
+
+    `reserve()` hands out the next number under a file lock, so concurrent
+    builders never write to the same output, and `commit()` marks a
+    finished build as the current one. The state is re-read only when the
+    state file changes; if it is missing, or the current output has been
+    removed behind our back, the directory is scanned once to rebuild it.
+    """
+    def __init__(self, directory: Path, name: str, ext: str = '') -> None:
+        self.directory = directory
+        self.prefix = name + '_'
+        self.ext = ext
+
+        self.file = directory.joinpath(f'.{name}.index.json')
+        self.lock_file = directory.joinpath(f'.{name}.index.lock')
+
+        self._pattern = re.compile(re.escape(self.prefix) + '([0-9]+)')
+        self._state = None
+        self._mtime = None
+
+    def path(self, idx: int) -> Path:
+        return self.directory.joinpath(f'{self.prefix}{idx}{self.ext}')
+
+    def scan(self) -> List[int]:
+        """ Every version present in the directory, in ascending order. """
+        if not self.directory.exists(): return []
+
+        found = []
+
+        for entry in os.scandir(self.directory):
+            if (match := self._pattern.match(entry.name)):
+                found.append(int(match.group(1)))
+
+        return sorted(set(found))
+
+    def _rebuild(self) -> dict:
+        found = self.scan()
+        highest = found[-1] if found else -1
+
+        return {'current': highest, 'next': highest + 1}
+
+    def _read(self) -> dict:
+        try:
+            stat = os.stat(self.file)
+            # The inode changes on every write, as writes replace the file
+            mtime = (stat.st_mtime_ns, stat.st_ino)
+        except FileNotFoundError:
+            self._state, self._mtime = None, None
+
+            return self._rebuild()
+
+        if self._state is None or mtime != self._mtime:
+            try:
+                with open(self.file) as fp:
+                    self._state = json.load(fp)
+            except ValueError:
+                return self._rebuild()
+
+            self._mtime = mtime
+
+        return self._state
+
+    def _write(self, state: dict) -> None:
+        write_json(self.file, state)
+
+        stat = os.stat(self.file)
+        self._state, self._mtime = state, (stat.st_mtime_ns, stat.st_ino)
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[dict]:
+        if not self.directory.exists():
+            os.makedirs(self.directory, exist_ok=True)
+
+        with file_lock(self.lock_file):
+            # Always re-read under the lock, another process may have written
+            self._state = None
+            state = dict(self._read())
+
+            yield state
+
+            self._write(state)
+
+    @property
+    def current(self) -> int:
+        state = self._read()
+        current = state['current']
+
+        if current >= 0 and not self.path(current).exists():
+            with self._locked() as state:
+                state['current'] = self._rebuild()['current']
+
+            current = state['current']
+
+        return current
+
+    @property
+    def next(self) -> int:
+        """ The number `reserve()` would hand out, without reserving it. """
+        return self._read()['next']
+
+    def reserve(self) -> int:
+        with self._locked() as state:
+            idx = state['next']
+            state['next'] = idx + 1
+
+        return idx
+
+    def commit(self, idx: int) -> None:
+        with self._locked() as state:
+            state['current'] = max(state['current'], idx)
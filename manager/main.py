@@ -1,12 +1,11 @@
 
-import os
+import os, json, time
 
 from pathlib import Path
-from dotenv import load_dotenv
 
-from .builder import Linker, Builder, process_steps
-from .clients import SteamCMD, ArmaClient, Service
+from . import profiling
 from .config import config
+from .daemon import Daemon, forward, request, socket_path
 
 from .const import (
     DEFAULT_CONFIG_FILE
@@ -15,7 +14,9 @@ from .const import (
 FLAG_CONVERTERS = {
     'r': 'run',
     'b': 'build',
-    'i': 'install'
+    'i': 'install',
+    'j': 'jobs',
+    'w': 'watch'
 }
 
 def parse_args(iargs: list):
@@ -42,41 +43,147 @@ def parse_args(iargs: list):
 
     return args, options
 
+def manage_caches(steps: list, action: str = None) -> None:
+    from .builder import BuilderOptions
+
+    seen = set()
+
+    for step in steps:
+        if step.get('type', '').lower() != 'build': continue
+
+        cache = BuilderOptions(**step).cache
+
+        if cache is None or cache.path in seen: continue
+        seen.add(cache.path)
+
+        if action is None:
+            entries = cache.entries()
+
+            for i in entries:
+                print('{0}  {1:>10.1f} MiB  {2}'.format(i.key, i.size / (1 << 20), time.ctime(i.last_used)))
+        elif action == 'prune':
+            entries = cache.prune()
+        elif action == 'clear':
+            entries = cache.clear()
+        else:
+            raise Exception(f'Unknown cache action {action}')
+
+        print('{0} [{1}]: {2} entries ({3:.1f} MiB), {4:.1f} MiB in use'.format(
+            cache.path, action or 'list', len(entries),
+            sum(x.size for x in entries) / (1 << 20), cache.size / (1 << 20)
+        ))
+
+def select_steps(names: str = None) -> list:
+    """ Steps from the validated build plan, all of them or those named in `names`. """
+    from .plan import build_plan
+
+    return build_plan(config).select(names and [x.strip() for x in names.split(',')])
+
 def main(args: list, options: dict):
     config.set_json_file(
         Path(options.get('config', DEFAULT_CONFIG_FILE))
     )
 
+    # The builder, the clients and dotenv are imported only by the commands
+    # using them, to keep startup short
     if 'env' in options:
+        from dotenv import load_dotenv
+
         load_dotenv(dotenv_path=options['env'])
 
     # Use False instead of None because options can still be present
     # even if value is None
     if (install := options.get('install', False)) is not False:
+        from .clients import install_services
+
         if install is None:
             install = config.services.keys()
 
-        for i in install:
-            service = Service.create(i, **config.services[i])
+        install_services(install.split(',') if isinstance(install, str) else list(install))
 
-            service.install()
+    # --sync-mods downloads the out-of-date workshop mods, --sync-mods=force all of them
+    if (sync := options.get('sync-mods', False)) is not False:
+        from .clients import ArmaClient
+
+        ArmaClient(**config.services['arma3']).sync_mods(sync == 'force')
+
+    if (cache := options.get('cache', False)) is not False:
+        manage_caches(select_steps(), cache)
+
+    jobs = options.get('jobs', 1)
+    jobs = os.cpu_count() if jobs is None else int(jobs)
 
     if (build := options.get('build', False)) is not False:
-        if build is None:
-            steps = config.steps
+        from .builder import process_steps
+
+        steps = select_steps(build)
+
+        # --plan only reports what the build would do
+        if 'plan' in options:
+            from .plan import print_estimates
+
+            print_estimates(steps)
+        else:
+            print('Running {0} steps ({1})'.format(len(steps), ', '.join([x['name'] for x in steps])))
+
+            profile = options.get('profile', False)
+            trace = options.get('trace')
+
+            if profile is not False or trace:
+                profiling.enable()
+
+            process_steps(steps, jobs)
+
+            # --profile prints a per-phase summary, --profile=FILE also writes
+            # it as JSON and --trace=FILE writes a Chrome trace
+            if profiling.enabled():
+                profiling.print_summary(profiling.spans())
+
+                if profile:
+                    profiling.write_json(profiling.spans(), Path(profile))
+
+                if trace:
+                    profiling.write_trace(profiling.spans(), Path(trace))
+
+    # --watch rebuilds the steps picked by --build (all of them without it),
+    # --watch=poll skips inotify
+    if (watch_ := options.get('watch', False)) is not False:
+        from .watch import watch
+
+        watch(select_steps(build or None), jobs, poll=watch_ == 'poll')
+
+    # --run starts the server, or every instance in `instances` under
+    # one supervisor
+    if ('run' in options):
+        from .clients import ArmaClient
+
+        client = ArmaClient(**config.services['arma3'])
+
+        if config.services['arma3'].get('instances'):
+            client.supervise()
         else:
-            steps = []
-            build = [x.strip() for x in build.split(',')]
+            client.run()
 
-            for i in config.steps:
-                if i.get('name', None) in build:
-                    steps.append(i)
+def daemon(action: str = None) -> None:
+    if action is None:
+        return Daemon().serve()
 
-        print('Running {0} steps ({1})'.format(len(steps), ', '.join([x['name'] for x in steps])))
-        
-        process_steps(steps)
+    if action not in ('status', 'stop'):
+        raise Exception(f'Unknown daemon action {action}')
 
-    if ('run' in options): ArmaClient(**config.services['arma3']).run()
+    if (reply := request(socket_path(), {'command': action})) is None:
+        print('No daemon running')
+    else:
+        print(json.dumps(reply, indent=4))
 
 def cli(args: list):
-    return main(*parse_args(args))
+    args, options = parse_args(args)
+
+    # --daemon runs the daemon in the foreground, --daemon=status|stop
+    # talks to a running one
+    if 'daemon' in options:
+        return daemon(options['daemon'])
+
+    # Builds go through a running daemon unless --no-daemon is given
+    if options.pop('no-daemon', False) is not False or not forward(args, options):
+        return main(args, options)
@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import os, json, hashlib
+
+from pathlib import Path
+from typing import (
+    Dict,
+    List,
+    NamedTuple,
+    Union
+)
+
+from .fsutil import write_json
+from .hashing import HashCache, hash_files
+
+class ManifestEntry(NamedTuple):
+    source: str
+    size: int
+    mtime: int
+    hash: str
+
+class ManifestDiff(NamedTuple):
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+    def __str__(self) -> str:
+        if not self:
+            return 'up to date'
+
+        return '{0} added, {1} changed, {2} removed'.format(
+            len(self.added), len(self.changed), len(self.removed)
+        )
+
+    @property
+    def dirty(self) -> List[str]:
+        return self.added + self.changed
+
+class Manifest:
+    """
+    Per-file record of a build step's inputs, keyed by the path of the file
+    inside the staged tree (posix separators).
+
+    Hashes are only recomputed for files whose source, size or mtime differs
+    from the previous manifest, so an unchanged tree costs one stat per file.
+    """
+    def __init__(self,
+            entries: Union[Dict[str, ManifestEntry], None] = None,
+            fingerprint: Union[dict, None] = None,
+            artifact: Union[dict, None] = None
+        ) -> None:
+        self.entries = entries or {}
+        self.fingerprint = fingerprint
+        # Path, size and mtime of the output built from these files
+        self.artifact = artifact
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @classmethod
+    def load(cls, file: Path) -> Manifest:
+        try:
+            with open(file) as fp:
+                data = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return cls()
+
+        return cls(
+            {k: ManifestEntry(*v) for k, v in data.get('files', {}).items()},
+            data.get('fingerprint'),
+            data.get('artifact')
+        )
+
+    def save(self, file: Path) -> Manifest:
+        if not file.parent.exists():
+            os.makedirs(file.parent)
+
+        write_json(file, {
+            'fingerprint': self.fingerprint,
+            'artifact': self.artifact,
+            'files': {k: list(v) for k, v in self.entries.items()}
+        })
+
+        return self
+
+    @classmethod
+    def from_files(cls,
+            files: Dict[str, Path],
+            previous: Union[Manifest, None] = None,
+            cache: Union[HashCache, None] = None
+        ) -> Manifest:
+        old_entries = previous.entries if previous is not None else {}
+        entries, misses = {}, {}
+
+        for name, src in files.items():
+            stat = os.stat(src)
+            source = os.fspath(src)
+            old = old_entries.get(name)
+
+            if old is not None and (old.source, old.size, old.mtime) == (source, stat.st_size, stat.st_mtime_ns):
+                entries[name] = old
+            else:
+                entries[name] = ManifestEntry(source, stat.st_size, stat.st_mtime_ns, '')
+                misses[name] = src
+
+        digests = hash_files(misses.values(), cache=cache)
+
+        for name, src in misses.items():
+            entries[name] = entries[name]._replace(hash=digests[src])
+
+        return cls(entries)
+
+    def digest(self) -> str:
+        """ Hash of the tree described by this manifest, independent of stat data. """
+        hsh = hashlib.sha1()
+
+        for name in sorted(self.entries):
+            hsh.update(name.encode('utf-8') + b'\0')
+            hsh.update(self.entries[name].hash.encode('ascii'))
+
+        return hsh.hexdigest()
+
+    def record_artifact(self, path: Path) -> Manifest:
+        stat = os.stat(path)
+        self.artifact = {'path': os.fspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+        return self
+
+    def artifact_path(self) -> Union[Path, None]:
+        """ The recorded artifact, if it still exists unchanged. """
+        if not self.artifact: return None
+
+        try:
+            stat = os.stat(self.artifact['path'])
+        except OSError:
+            return None
+
+        if (stat.st_size, stat.st_mtime_ns) != (self.artifact['size'], self.artifact['mtime']):
+            return None
+
+        return Path(self.artifact['path'])
+
+    def verify(self) -> ManifestDiff:
+        """
+        Recorded files that were changed or removed on disk since. Files
+        added next to them are not looked at, and only files whose size or
+        mtime changed are hashed again.
+        """
+        files = {k: Path(v.source) for k, v in self.entries.items() if os.path.isfile(v.source)}
+
+        return self.diff(Manifest.from_files(files, self))
+
+    def diff(self, new: Manifest) -> ManifestDiff:
+        added, changed = [], []
+
+        for name, entry in new.entries.items():
+            old = self.entries.get(name)
+
+            if old is None:
+                added.append(name)
+            elif old.hash != entry.hash:
+                changed.append(name)
+
+        removed = [x for x in self.entries if x not in new.entries]
+
+        return ManifestDiff(sorted(added), sorted(changed), sorted(removed))
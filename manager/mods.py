@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import os, threading
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import (
+    Dict,
+    List,
+    NamedTuple,
+    Union
+)
+
+from .clients import BatchResult, ItemResult, SteamBatch
+from .const import ARMA_WORKSHOP_ID, IS_LINUX
+from .fsutil import remove_path, replace, temp_sibling
+from .manifest import Manifest
+
+DETAILS_URL = 'https://api.steampowered.com/ISteamRemoteStorage/GetPublishedFileDetails/v1/'
+
+# Sync state inside the mods directory: per-mod manifests and the
+# directories the workers download into
+STATE_DIR = '.manager-mods'
+
+class ModStatus(NamedTuple):
+    name: str
+    item_id: str
+    # Why the mod needs downloading, None if it is up to date
+    reason: Union[str, None]
+    time_updated: Union[int, None]
+
+def workshop_updated(item_ids: List[str], timeout: float = 30) -> Dict[str, int]:
+    """
+    Time of the last update of each workshop item, in one request. Items
+    that are missing or could not be looked up are left out.
+    """
+    import requests
+
+    if not item_ids: return {}
+
+    data = {'itemcount': len(item_ids)}
+
+    for idx, item_id in enumerate(item_ids):
+        data[f'publishedfileids[{idx}]'] = item_id
+
+    r = requests.post(DETAILS_URL, data=data, timeout=timeout)
+    r.raise_for_status()
+
+    return {
+        str(x['publishedfileid']): int(x['time_updated'])
+        for x in r.json().get('response', {}).get('publishedfiledetails', [])
+        if x.get('result') == 1 and 'time_updated' in x
+    }
+
+def normalize(path: str, lowercase: bool) -> str:
+    """ Workshop paths with posix separators, lowercased for Linux servers. """
+    path = path.replace('\\', '/')
+
+    return path.lower() if lowercase else path
+
+class ModSync:
+    """
+    Keeps the workshop mods of a mods directory up to date.
+
+    Each mod's manifest records the workshop item, its update time and its
+    files. A mod is downloaded again when the workshop has a newer version,
+    when it was synced with other settings, or when its recorded files were
+    changed or removed; everything else is left alone. Out-of-date mods are
+    split between `jobs` SteamCMD workers, each downloading its share in a
+    single session into a directory of its own. The downloaded files are
+    then moved into place, normalized on the way.
+    """
+    def __init__(self, mods_dir: Path, workshop: Dict[str, Union[str, int]], jobs: int = 2,
+            lowercase: bool = IS_LINUX, steamcmd: Union[dict, None] = None) -> None:
+        self.mods_dir = Path(mods_dir)
+        self.workshop = {name: str(item_id) for name, item_id in workshop.items()}
+        self.jobs = max(1, jobs)
+        self.lowercase = lowercase
+        self.steamcmd = steamcmd
+
+        self._print_lock = threading.Lock()
+
+    @property
+    def state_dir(self) -> Path:
+        return self.mods_dir.joinpath(STATE_DIR)
+
+    def state_file(self, item_id: str) -> Path:
+        return self.state_dir.joinpath(f'{item_id}.json')
+
+    def dest(self, name: str) -> Path:
+        return self.mods_dir.joinpath(normalize(name, self.lowercase))
+
+    def _status(self, name: str, item_id: str, updated: Dict[str, int]) -> ModStatus:
+        time_updated = updated.get(item_id)
+        recorded = Manifest.load(self.state_file(item_id))
+        fingerprint = recorded.fingerprint or {}
+
+        if not recorded.entries or not self.dest(name).is_dir():
+            reason = 'not installed'
+        elif fingerprint.get('lowercase') != self.lowercase or fingerprint.get('dest') != os.fspath(self.dest(name)):
+            reason = 'sync settings changed'
+        elif time_updated is not None and fingerprint.get('time_updated') != time_updated:
+            reason = 'updated on the workshop'
+        elif (drift := recorded.verify()):
+            reason = f'local changes ({drift})'
+        else:
+            reason = None
+
+        return ModStatus(name, item_id, reason, time_updated)
+
+    def status(self) -> List[ModStatus]:
+        try:
+            updated = workshop_updated(sorted(set(self.workshop.values())))
+        except Exception as e:
+            # Offline: installed mods are kept as they are
+            print(f'Could not look up workshop items: {e}')
+            updated = {}
+
+        return [self._status(name, item_id, updated) for name, item_id in self.workshop.items()]
+
+    def _install(self, mod: ModStatus, result: ItemResult) -> None:
+        """ Move a downloaded item into place, normalizing every path, and record it. """
+        src = Path(result.item.install_dir).joinpath(
+            'steamapps', 'workshop', 'content', ARMA_WORKSHOP_ID, mod.item_id
+        )
+        dest = self.dest(mod.name)
+        tmp = temp_sibling(dest, 'sync')
+        remove_path(tmp)
+
+        for root, _, names in os.walk(src):
+            rel = Path(root).relative_to(src).as_posix()
+
+            for name in names:
+                target = tmp.joinpath(normalize(os.path.join(rel, name) if rel != '.' else name, self.lowercase))
+
+                if target.exists():
+                    print(f'{mod.name}: {target.relative_to(tmp)} exists in several spellings, keeping one')
+
+                os.makedirs(target.parent, exist_ok=True)
+                os.replace(os.path.join(root, name), target)
+
+        replace(tmp, dest)
+        remove_path(src)
+
+        files = {}
+
+        for root, _, names in os.walk(dest):
+            for name in names:
+                path = Path(root, name)
+                files[path.relative_to(dest).as_posix()] = path
+
+        manifest = Manifest.from_files(files)
+        manifest.fingerprint = {
+            'item': mod.item_id,
+            'time_updated': mod.time_updated,
+            'lowercase': self.lowercase,
+            'dest': os.fspath(dest)
+        }
+        manifest.save(self.state_file(mod.item_id))
+
+    def _worker(self, idx: int, mods: List[ModStatus]) -> BatchResult:
+        batch = SteamBatch(self.steamcmd)
+        install_dir = self.state_dir.joinpath(f'worker-{idx}').absolute()
+
+        for mod in mods:
+            batch.workshop_download_item(
+                ARMA_WORKSHOP_ID, mod.item_id, install_dir,
+                done=lambda result, mod=mod: self._install(mod, result)
+            )
+
+        results = batch.run(echo=self.jobs == 1)
+
+        with self._print_lock:
+            for result in results:
+                print('{0}: {1} {2}'.format(result.item, 'ok' if result.ok else 'failed', result.message))
+
+        return results
+
+    def sync(self, force: bool = False) -> List[ModStatus]:
+        """ Download the mods that are out of date, all of them with `force`. Returns those synced. """
+        stale = []
+
+        for mod in self.status():
+            if force and mod.reason is None:
+                mod = mod._replace(reason='forced')
+
+            if mod.reason is not None:
+                print(f'{mod.name}: {mod.reason}')
+                stale.append(mod)
+
+        if not stale: return []
+
+        os.makedirs(self.state_dir, exist_ok=True)
+
+        shares = [stale[i::self.jobs] for i in range(min(self.jobs, len(stale)))]
+        results = BatchResult()
+
+        with ThreadPoolExecutor(len(shares)) as pool:
+            for share_results in pool.map(self._worker, range(len(shares)), shares):
+                results.extend(share_results)
+
+        results.check()
+
+        return stale
@@ -0,0 +1,463 @@
+from __future__ import annotations
+
+import os, struct, hashlib, tempfile, collections, concurrent.futures
+
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Tuple,
+    Union
+)
+
+# https://community.bistudio.com/wiki/PBO_File_Format
+
+METHOD_STORED = 0
+METHOD_COMPRESSED = 0x43707273 # 'Cprs'
+METHOD_VERSION = 0x56657273 # 'Vers', product entry followed by key/value strings
+
+# originalsize, reserved, timestamp and datasize follow the packing method
+HEADER = struct.Struct('<5I')
+
+COPY_BUF_SIZE = 1024 * 1024
+
+# Text formats; binary assets (textures, models, sounds) are already dense
+COMPRESSIBLE = (
+    '.sqf', '.sqs', '.fsm', '.hpp', '.cpp', '.h', '.inc', '.ext',
+    '.sqm', '.bikb', '.txt', '.xml', '.csv', '.html', '.json'
+)
+
+LZSS_MIN_LEN = 3
+LZSS_MAX_LEN = 18
+LZSS_WINDOW = 4095
+LZSS_MAX_CHAIN = 32
+
+class Entry(NamedTuple):
+    name: str
+    source: Path
+
+class Header(NamedTuple):
+    name: str
+    method: int
+    original_size: int
+    data_size: int
+
+    def pack(self) -> bytes:
+        return self.name.encode('ascii') + b'\0' + HEADER.pack(
+            self.method, self.original_size, 0, 0, self.data_size
+        )
+
+# The empty entry closing the header list
+TERMINATOR = Header('', 0, 0, 0)
+
+def files_from_directory(root: Path) -> Dict[str, Path]:
+    files = {}
+
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = Path(dirpath, name)
+            files[path.relative_to(root).as_posix()] = path
+
+    return files
+
+def sort_entries(files: Dict[str, Path]) -> List[Entry]:
+    """
+    Entries named with backslashes and sorted case-insensitively, which is
+    the order pboutil's PBOFile ends up with.
+    """
+    entries = sorted(
+        (Entry(k.replace('/', '\\'), Path(v)) for k, v in files.items()),
+        key=lambda x: x.name.lower()
+    )
+
+    for a, b in zip(entries, entries[1:]):
+        if a.name.lower() == b.name.lower():
+            raise Exception(f'Duplicate entry {b.name}')
+
+    return entries
+
+def lzss_compress(data: bytes) -> bytes:
+    """
+    Compress with the LZSS variant used by Arma: a flag byte per 8 blocks
+    (bit set: literal byte, clear: 2 byte back reference of 12 bits distance
+    and 4 bits length - 3), followed by the unsigned byte sum of the input.
+    """
+    out = bytearray()
+    chains = {}
+    pos, size = 0, len(data)
+
+    def remember(start: int, end: int) -> None:
+        for p in range(start, min(end, size - LZSS_MIN_LEN + 1)):
+            chain = chains.setdefault(data[p:p + LZSS_MIN_LEN], [])
+            chain.append(p)
+
+            if len(chain) > LZSS_MAX_CHAIN * 2:
+                del chain[:-LZSS_MAX_CHAIN]
+
+    while pos < size:
+        flag_idx = len(out)
+        flags = 0
+        out.append(0)
+
+        for bit in range(8):
+            if pos >= size: break
+
+            best_len = best_dist = 0
+            max_len = min(LZSS_MAX_LEN, size - pos)
+
+            if max_len >= LZSS_MIN_LEN:
+                for cand in reversed(chains.get(data[pos:pos + LZSS_MIN_LEN], ())[-LZSS_MAX_CHAIN:]):
+                    dist = pos - cand
+                    if dist > LZSS_WINDOW: break
+
+                    length = LZSS_MIN_LEN
+                    while length < max_len and data[cand + length] == data[pos + length]:
+                        length += 1
+
+                    if length > best_len:
+                        best_len, best_dist = length, dist
+
+                        if length == max_len: break
+
+            if best_len:
+                out.append(best_dist & 0xFF)
+                out.append(((best_dist >> 4) & 0xF0) | (best_len - LZSS_MIN_LEN))
+                step = best_len
+            else:
+                flags |= 1 << bit
+                out.append(data[pos])
+                step = 1
+
+            remember(pos, pos + step)
+            pos += step
+
+        out[flag_idx] = flags
+
+    out += struct.pack('<I', sum(data) & 0xFFFFFFFF)
+
+    return bytes(out)
+
+def lzss_decompress(data: bytes, size: int) -> bytes:
+    out = bytearray()
+    i = 0
+
+    while len(out) < size:
+        flags = data[i]
+        i += 1
+
+        for bit in range(8):
+            if len(out) >= size: break
+
+            if flags & (1 << bit):
+                out.append(data[i])
+                i += 1
+                continue
+
+            dist = data[i] | ((data[i + 1] & 0xF0) << 4)
+            length = (data[i + 1] & 0x0F) + LZSS_MIN_LEN
+            i += 2
+
+            start = len(out) - dist
+            if start < 0:
+                raise Exception('Invalid LZSS back reference')
+
+            for k in range(length):
+                out.append(out[start + k])
+
+    del out[size:]
+
+    if struct.unpack_from('<I', data, i)[0] != sum(out) & 0xFFFFFFFF:
+        raise Exception('LZSS checksum mismatch')
+
+    return bytes(out)
+
+def pack_entry(source: Path) -> Tuple[int, int, bytes]:
+    """ Compress a single file. Returns (method, original size, data). """
+    with open(source, 'rb') as fp:
+        data = fp.read()
+
+    packed = lzss_compress(data)
+
+    # Not worth it, the engine reads stored entries directly
+    if len(packed) >= len(data):
+        return METHOD_STORED, 0, data
+
+    return METHOD_COMPRESSED, len(data), packed
+
+def ordered_map(executor: Union[Executor, None], fn: Callable, items: Iterable, window: int) -> Iterator[Any]:
+    """
+    Like executor.map(), but with at most `window` items in flight so
+    results are never buffered much further ahead than they are consumed.
+    """
+    if executor is None:
+        yield from map(fn, items)
+        return
+
+    pending = collections.deque()
+
+    for item in items:
+        pending.append(executor.submit(fn, item))
+
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+class HashingWriter:
+    """ File wrapper that feeds everything written through SHA1 for the trailer. """
+    def __init__(self, fp: BinaryIO) -> None:
+        self.fp = fp
+        self.hsh = hashlib.sha1()
+        self.written = 0
+
+    def write(self, data: bytes) -> None:
+        self.fp.write(data)
+        self.hsh.update(data)
+        self.written += len(data)
+
+    def copy_from(self, fp: BinaryIO, size: int, name: str = '') -> None:
+        while size > 0:
+            buf = fp.read(min(COPY_BUF_SIZE, size))
+
+            if not buf:
+                raise Exception(f'{name or fp} is shorter than expected')
+
+            self.write(buf)
+            size -= len(buf)
+
+    def finish(self) -> None:
+        self.fp.write(b'\0' + self.hsh.digest())
+
+def copy_source(writer: HashingWriter, entry: Entry, size: int) -> None:
+    with open(entry.source, 'rb') as fp:
+        writer.copy_from(fp, size, entry.source)
+
+        if fp.read(1):
+            raise Exception(f'{entry.source} changed while packing')
+
+def write_stored(writer: HashingWriter, entries: List[Entry]) -> None:
+    """ Single pass: headers from stat, then every file streamed in order. """
+    sizes = [os.stat(x.source).st_size for x in entries]
+
+    for entry, size in zip(entries, sizes):
+        writer.write(Header(entry.name, METHOD_STORED, 0, size).pack())
+
+    writer.write(TERMINATOR.pack())
+
+    for entry, size in zip(entries, sizes):
+        copy_source(writer, entry, size)
+
+def spool_packed(
+        entries: List[Entry],
+        spool: BinaryIO,
+        jobs: Union[int, None] = None
+    ) -> Dict[str, Tuple[Header, int]]:
+    """
+    Compress `entries` on a process pool, in order and with a bounded number
+    in flight, appending the results to `spool`. Returns each entry's header
+    and offset in the spool.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    # Through the package, which only imports multiprocessing when needed
+    executor = concurrent.futures.ProcessPoolExecutor(jobs) if jobs > 1 and len(entries) > 1 else None
+    packed = {}
+
+    try:
+        results = ordered_map(executor, pack_entry, [x.source for x in entries], jobs * 2)
+
+        for entry, (method, original, data) in zip(entries, results):
+            packed[entry.name] = (Header(entry.name, method, original, len(data)), spool.tell())
+            spool.write(data)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return packed
+
+def write_compressed(
+        writer: HashingWriter,
+        entries: List[Entry],
+        compressible: Callable[[str], bool],
+        jobs: Union[int, None] = None,
+        spool_dir: Union[Path, None] = None
+    ) -> None:
+    """
+    The headers need the compressed sizes before any data is written, so
+    compressed data is spooled to a temporary file meanwhile; entries that
+    are not compressed are streamed straight from the source.
+    """
+    with tempfile.TemporaryFile(dir=spool_dir) as spool:
+        packed = spool_packed([x for x in entries if compressible(x.name)], spool, jobs)
+        headers = []
+
+        for entry in entries:
+            if entry.name in packed:
+                header = packed[entry.name][0]
+            else:
+                header = Header(entry.name, METHOD_STORED, 0, os.stat(entry.source).st_size)
+
+            headers.append(header)
+            writer.write(header.pack())
+
+        writer.write(TERMINATOR.pack())
+
+        for entry, header in zip(entries, headers):
+            if entry.name in packed:
+                spool.seek(packed[entry.name][1])
+                writer.copy_from(spool, header.data_size, entry.source)
+            else:
+                copy_source(writer, entry, header.data_size)
+
+def _read_cstring(fp: BinaryIO) -> str:
+    buf = bytearray()
+
+    while (char := fp.read(1)) != b'\0':
+        if not char:
+            raise Exception('Unexpected end of PBO header')
+
+        buf += char
+
+    return buf.decode('ascii')
+
+def read_headers(fp: BinaryIO) -> Tuple[List[Header], int]:
+    """ Headers of the PBO open in `fp` and the offset its data starts at. """
+    headers = []
+
+    while True:
+        name = _read_cstring(fp)
+        method, original, _, _, size = HEADER.unpack(fp.read(HEADER.size))
+
+        if not name:
+            if method == METHOD_VERSION and not headers:
+                while _read_cstring(fp): pass
+
+                continue
+
+            break
+
+        headers.append(Header(name, method, original, size))
+
+    return headers, fp.tell()
+
+def _write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+
+    while view:
+        view = view[os.write(fd, view):]
+
+def _copy_range(src_fd: int, dst_fd: int, offset: int, size: int) -> None:
+    """ Copy `size` bytes at `offset` to the current position of `dst_fd`, in the kernel where possible. """
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while size > 0:
+                copied = os.copy_file_range(src_fd, dst_fd, size, offset)
+                if not copied: break
+
+                offset += copied
+                size -= copied
+        except OSError:
+            pass
+
+    while size > 0:
+        buf = os.pread(src_fd, min(COPY_BUF_SIZE, size), offset)
+
+        if not buf:
+            raise Exception('Previous PBO is shorter than its headers claim')
+
+        _write_all(dst_fd, buf)
+        offset += len(buf)
+        size -= len(buf)
+
+def write_delta(
+        fd: int,
+        entries: List[Entry],
+        previous: Path,
+        changed: Iterable[str],
+        compressible: Callable[[str], bool],
+        jobs: Union[int, None] = None,
+        spool_dir: Union[Path, None] = None
+    ) -> int:
+    """
+    Write a PBO to the raw file descriptor `fd`, reusing the packed bytes of
+    every entry of `previous` that is not in `changed` (posix or backslash
+    paths). Reused entries are copied with copy_file_range(), so only new
+    data passes through userspace. The SHA1 trailer still covers the whole
+    archive, so the output is read back once to compute it.
+
+    Returns the number of entries reused.
+    """
+    changed = {x.replace('/', '\\').lower() for x in changed}
+
+    with open(previous, 'rb') as old_fp, tempfile.TemporaryFile(dir=spool_dir) as spool:
+        old_headers, old_offset = read_headers(old_fp)
+        old = {}
+
+        for header in old_headers:
+            old[header.name.lower()] = (header, old_offset)
+            old_offset += header.data_size
+
+        reused, fresh = {}, []
+
+        for entry in entries:
+            key = entry.name.lower()
+            header, offset = old.get(key, (None, 0))
+
+            if header is not None and key not in changed:
+                size = os.stat(entry.source).st_size
+
+                # Only reuse entries that still describe the same file and
+                # were packed the way this entry would be
+                if header.method == METHOD_STORED:
+                    valid = header.data_size == size
+                else:
+                    valid = header.method == METHOD_COMPRESSED and header.original_size == size
+
+                if valid and (header.method == METHOD_STORED or compressible(entry.name)):
+                    reused[entry.name] = (header._replace(name=entry.name), offset)
+                    continue
+
+            fresh.append(entry)
+
+        packed = spool_packed([x for x in fresh if compressible(x.name)], spool, jobs)
+        headers = []
+
+        for entry in entries:
+            if entry.name in reused:
+                header = reused[entry.name][0]
+            elif entry.name in packed:
+                header = packed[entry.name][0]
+            else:
+                header = Header(entry.name, METHOD_STORED, 0, os.stat(entry.source).st_size)
+
+            headers.append(header)
+
+        _write_all(fd, b''.join(x.pack() for x in headers) + TERMINATOR.pack())
+
+        spool.flush()
+
+        for entry, header in zip(entries, headers):
+            if entry.name in reused:
+                _copy_range(old_fp.fileno(), fd, reused[entry.name][1], header.data_size)
+            elif entry.name in packed:
+                _copy_range(spool.fileno(), fd, packed[entry.name][1], header.data_size)
+            else:
+                with open(entry.source, 'rb') as fp:
+                    _copy_range(fp.fileno(), fd, 0, header.data_size)
+
+    hsh = hashlib.sha1()
+    end = os.lseek(fd, 0, os.SEEK_CUR)
+
+    for offset in range(0, end, COPY_BUF_SIZE):
+        hsh.update(os.pread(fd, min(COPY_BUF_SIZE, end - offset), offset))
+
+    _write_all(fd, b'\0' + hsh.digest())
+
+    return len(reused)
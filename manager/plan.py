@@ -0,0 +1,403 @@
+from __future__ import annotations
+
+import os, json, hashlib, inspect
+
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    List,
+    NamedTuple,
+    Tuple,
+    Union
+)
+
+from .builder import BINARIZERS, Builder, BuilderOptions, Linker
+from .cache import parse_size
+from .config import FrozenDict, FrozenList
+from .fsutil import write_json
+from .retention import RetentionPolicy
+from .scheduler import Scheduler
+
+# Bumped whenever the layout of a planned step or its validation changes
+PLAN_VERSION = 2
+
+_PATH = (str, list)
+
+# Option name -> accepted types, or a nested schema for objects. A tuple
+# may hold one nested schema, applied when the value is an object.
+CACHE_SCHEMA = {
+    'dir': _PATH,
+    'max_size': (int, str)
+}
+
+RETENTION_SCHEMA = {
+    'keep_last': int,
+    'max_age': (int, float, str)
+}
+
+OUTPUT_SCHEMA = {
+    'dir': _PATH,
+    'missions_dir': _PATH,
+    'tmp_dir': _PATH,
+    'filename': str,
+    'should_binarize': bool,
+    'binarizer': str,
+    'binarizer_options': dict,
+    'staging': str,
+    'copy': str,
+    'incremental': bool,
+    'cache': (str, list, CACHE_SCHEMA),
+    'hash_cache': _PATH,
+    'retention': (int, RETENTION_SCHEMA),
+    'links': (list, dict, str)
+}
+
+VARIANT_SCHEMA = {
+    'include': list,
+    'output': OUTPUT_SCHEMA
+}
+
+STEP_SCHEMAS = {
+    'build': {
+        'name': str,
+        'type': str,
+        'depends_on': (str, list),
+        'source_dir': _PATH,
+        'include': list,
+        'variants': (list, dict),
+        'variant_jobs': int,
+        'output': OUTPUT_SCHEMA
+    },
+    'link': {
+        'name': str,
+        'type': str,
+        'depends_on': (str, list),
+        'source': _PATH,
+        'dest': (str, list),
+        'symlink': bool,
+        'copy': str
+    }
+}
+
+REQUIRED = {
+    'build': ('source_dir',),
+    'link': ('source', 'dest')
+}
+
+def _check(value: Any, schema: Union[dict, type, tuple], where: str, errors: List[str]) -> None:
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            errors.append(f'{where}: expected an object')
+            return
+
+        for k, v in value.items():
+            if k not in schema:
+                errors.append(f'{where}: unknown option {k}')
+            elif v is not None:
+                _check(v, schema[k], f'{where}.{k}', errors)
+
+        return
+
+    types = schema if isinstance(schema, tuple) else (schema,)
+
+    if isinstance(value, dict) and (nested := [x for x in types if isinstance(x, dict)]):
+        _check(value, nested[0], where, errors)
+        return
+
+    types = tuple(dict if isinstance(x, dict) else x for x in types)
+
+    # bool is an int, but `"retention": true` is a mistake
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+        names = ' or '.join(x.__name__ for x in types)
+        errors.append(f'{where}: expected {names}, got {type(value).__name__}')
+
+def validate_step(step: dict, where: str) -> List[str]:
+    """ Schema errors of a single step. """
+    errors = []
+
+    if not isinstance(step, dict):
+        return [f'{where}: expected an object']
+
+    type_ = step.get('type')
+
+    if not isinstance(type_, str) or type_.lower() not in STEP_SCHEMAS:
+        return [f'{where}: unknown type {type_}']
+
+    type_ = type_.lower()
+    _check(step, STEP_SCHEMAS[type_], where, errors)
+
+    for key in REQUIRED[type_]:
+        if step.get(key) is None:
+            errors.append(f'{where}: missing {key}')
+
+    if isinstance(variants := step.get('variants'), dict):
+        for name, variant in variants.items():
+            if variant is not None:
+                _check(variant, VARIANT_SCHEMA, f'{where}.variants.{name}', errors)
+
+    return errors
+
+def _abspath(path: Any) -> str:
+    if isinstance(path, list):
+        path = os.path.join(*path)
+
+    return os.path.abspath(path)
+
+def _plan_links(links: Any) -> Any:
+    if isinstance(links, dict):
+        return {**links, 'dest': _plan_links(links['dest'])}
+
+    if isinstance(links, list):
+        return [_abspath(x) for x in links]
+
+    return _abspath(links)
+
+# Binarizer arguments that are set by the builder rather than the config
+_BINARIZER_ARGS = {'self', 'path', 'out_path', 'files', 'previous', 'changed'}
+
+def _check_output(opts: BuilderOptions) -> List[str]:
+    """ Errors in the values of an output, which the schema only checks the type of. """
+    errors = []
+
+    if opts.should_binarize:
+        params = inspect.signature(opts.binarizer.__init__).parameters
+        accepted = set(params) - _BINARIZER_ARGS
+
+        if not any(x.kind == x.VAR_KEYWORD for x in params.values()):
+            for name in opts.binarizer_options:
+                if name not in accepted:
+                    errors.append('unknown option binarizer_options.{0} of {1} (accepts {2})'.format(
+                        name, opts.binarizer.__name__, ', '.join(sorted(accepted)) or 'none'
+                    ))
+
+    if isinstance(cache := opts.output['cache'], dict):
+        try:
+            parse_size(cache.get('max_size'))
+        except Exception as e:
+            errors.append(f'cache.max_size: {e}')
+
+        if not cache.get('dir'):
+            errors.append('cache: missing dir')
+
+    try:
+        RetentionPolicy.from_options(opts.output['retention'])
+    except Exception as e:
+        errors.append(f'retention: {e}')
+
+    return errors
+
+def _plan_build(step: dict) -> dict:
+    opts = BuilderOptions(**step)
+    errors = _check_output(opts)
+
+    # variant() raises for invalid variant options
+    for name in opts.variants:
+        errors.extend(f'variant {name}: {x}' for x in _check_output(opts.variant(name)))
+
+    if errors:
+        raise Exception('; '.join(errors))
+
+    output = dict(step.get('output', {}))
+    names = {v: k for k, v in BINARIZERS.items()}
+
+    output['binarizer'] = names[opts.binarizer] if opts.should_binarize else None
+    output['dir'] = str(opts.missions_dir)
+    output['tmp_dir'] = str(opts.tmp_dir)
+    output.pop('missions_dir', None)
+
+    if (cache := output.get('cache')):
+        cache = cache if isinstance(cache, dict) else {'dir': cache}
+        output['cache'] = {**cache, 'dir': str(opts._process_path(cache['dir']))}
+
+    if output.get('hash_cache'):
+        output['hash_cache'] = str(opts._process_path(output['hash_cache']))
+
+    if output.get('links'):
+        output['links'] = _plan_links(output['links'])
+
+    return {**step, 'type': 'build', 'source_dir': str(opts.source_dir), 'output': output}
+
+def _plan_link(step: dict) -> dict:
+    Linker(**{k: v for k, v in step.items() if k not in ('name', 'type', 'depends_on')})
+
+    return {**step, 'type': 'link', 'source': _abspath(step['source']), 'dest': _plan_links(step['dest'])}
+
+def _freeze(value: Any) -> Any:
+    if isinstance(value, dict):
+        return FrozenDict({k: _freeze(v) for k, v in value.items()})
+    elif isinstance(value, (list, tuple)):
+        return FrozenList([_freeze(x) for x in value])
+
+    return value
+
+class BuildPlan(NamedTuple):
+    """
+    Validated steps with every path made absolute, every binarizer checked
+    and every default that depends on the working directory applied, so a
+    build can start from it without looking at the config again. `key`
+    identifies the config, environment and working directory it came from.
+    """
+    key: str
+    env: Dict[str, str]
+    steps: Tuple[dict, ...]
+
+    @classmethod
+    def compile(cls, steps: List[dict], key: str = '', env: Dict[str, str] = {}) -> BuildPlan:
+        """ Validate all of `steps` at once, raising with every error found. """
+        errors, planned = [], []
+
+        for idx, step in enumerate(steps):
+            where = 'step {0}'.format(step.get('name', idx) if isinstance(step, dict) else idx)
+
+            if (step_errors := validate_step(step, where)):
+                errors.extend(step_errors)
+                continue
+
+            try:
+                if step['type'].lower() == 'build':
+                    planned.append(_plan_build(step))
+                else:
+                    planned.append(_plan_link(step))
+            except Exception as e:
+                errors.append(f'{where}: {e}')
+
+        if not errors:
+            names = {x.get('name') for x in planned}
+
+            for step in planned:
+                depends_on = step.get('depends_on') or []
+
+                for x in [depends_on] if isinstance(depends_on, str) else depends_on:
+                    if x not in names:
+                        errors.append('step {0}: depends on unknown step {1}'.format(step.get('name'), x))
+
+            try:
+                Scheduler(planned)
+            except Exception as e:
+                errors.append(str(e))
+
+        if errors:
+            raise Exception('Invalid steps:\n  ' + '\n  '.join(errors))
+
+        return cls(key, dict(env), tuple(_freeze(x) for x in planned))
+
+    def select(self, names: Union[List[str], None] = None) -> List[dict]:
+        if names is None: return list(self.steps)
+
+        known = {x.get('name') for x in self.steps}
+
+        if (unknown := [x for x in names if x not in known]):
+            raise Exception('Unknown steps {0}'.format(', '.join(unknown)))
+
+        return [x for x in self.steps if x.get('name') in names]
+
+    def is_current(self, key: str) -> bool:
+        return self.key == key and all(os.environ.get(k) == v for k, v in self.env.items())
+
+    def as_dict(self) -> dict:
+        return {'version': PLAN_VERSION, 'key': self.key, 'env': self.env, 'steps': list(self.steps)}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Union[BuildPlan, None]:
+        if data.get('version') != PLAN_VERSION: return None
+
+        return cls(data['key'], data['env'], tuple(_freeze(x) for x in data['steps']))
+
+    def save(self, file: Path) -> BuildPlan:
+        write_json(file, self.as_dict(), indent=4)
+
+        return self
+
+    @classmethod
+    def load(cls, file: Path) -> Union[BuildPlan, None]:
+        try:
+            with open(file) as fp:
+                return cls.from_dict(json.load(fp))
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+# Plans compiled in this process, by config file
+_plans = {}
+
+def plan_file(config_file: Path) -> Path:
+    config_file = Path(config_file)
+
+    return config_file.with_name(f'.{config_file.name}.plan.json')
+
+def config_key(config_file: Path) -> str:
+    hsh = hashlib.sha1(str(PLAN_VERSION).encode('ascii'))
+    hsh.update(os.getcwd().encode('utf-8') + b'\0')
+
+    with open(config_file, 'rb') as fp:
+        hsh.update(fp.read())
+
+    return hsh.hexdigest()
+
+def build_plan(config) -> BuildPlan:
+    """
+    The plan of `config.steps`, reused from memory or from the plan file
+    next to the config when neither the config file, the environment
+    variables it refers to, nor the working directory have changed.
+    """
+    file = Path(config.file)
+    key = config_key(file)
+
+    if (plan := _plans.get(file)) is None or not plan.is_current(key):
+        if (plan := BuildPlan.load(plan_file(file))) is None or not plan.is_current(key):
+            steps = config.steps or []
+            plan = BuildPlan.compile(steps, key, config.environment('steps'))
+
+            try:
+                plan.save(plan_file(file))
+            except OSError:
+                pass
+
+        _plans[file] = plan
+
+    return plan
+
+def _size(size: int) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024: break
+
+        size /= 1024
+    else:
+        unit = 'GiB'
+
+    return '{0:.1f} {1}'.format(size, unit) if unit != 'B' else f'{size} B'
+
+def print_estimates(steps: List[dict]) -> None:
+    """
+    Dry run of `steps` (see `Builder.estimate()`): what each would read,
+    copy and pack, whether its output is cached and which links change.
+    """
+    copied = packed = 0
+
+    for step in steps:
+        step = dict(step)
+        name, type_ = step.pop('name', ''), step.pop('type').lower()
+        step.pop('depends_on', None)
+
+        if type_ == 'link':
+            print(f'{name}: link {step["source"]}')
+
+            for dest, action in Linker(**step).plan():
+                print(f'    {dest}: {action}')
+
+            continue
+
+        for est in Builder(step).estimate():
+            copied += est.copy_size
+            packed += est.pack_size
+
+            print('{0} ({1}): {2} files, {3}, copy {4}, pack {5}, {6}cache {7}'.format(
+                name, est.name, est.files, _size(est.size), _size(est.copy_size), _size(est.pack_size),
+                '' if est.changed is None else f'{est.changed} changed, ', est.cache
+            ))
+            print(f'    output {est.output}')
+
+            for dest, action in est.links:
+                print(f'    {dest}: {action}')
+
+    print('Total: copy {0}, pack {1}'.format(_size(copied), _size(packed)))
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import os, json, time, threading, contextlib
+
+from pathlib import Path
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    Tuple,
+    Union
+)
+
+class Span:
+    """
+    One timed phase. `bytes` and `files` are filled in by the code being
+    timed, where it knows how much it processed.
+    """
+    __slots__ = ('name', 'step', 'start', 'wall', 'cpu', 'bytes', 'files', 'pid', 'tid')
+
+    def __init__(self, name: str, step: str = '') -> None:
+        self.name = name
+        self.step = step
+        self.start = 0.0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes = 0
+        self.files = 0
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+
+    def as_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+class _Disabled:
+    """ Stand-in yielded when profiling is off, so callers can set counters unconditionally. """
+    bytes = files = 0
+
+    def __setattr__(self, name, value) -> None:
+        pass
+
+_DISABLED = _Disabled()
+
+# Spans of the current process; None while profiling is off
+_spans: Union[List[Span], None] = None
+_step = threading.local()
+
+def enable() -> None:
+    global _spans
+
+    _spans = []
+
+def enabled() -> bool:
+    return _spans is not None
+
+def spans() -> List[Span]:
+    return list(_spans or [])
+
+def add(spans_: List[Span]) -> None:
+    """ Merge spans recorded elsewhere, e.g. by a worker process. """
+    if _spans is not None:
+        _spans.extend(spans_)
+
+def current_step() -> str:
+    return getattr(_step, 'name', '')
+
+@contextlib.contextmanager
+def attributed_to(name: str) -> Iterator[None]:
+    """
+    Attribute the phases of the calling thread to step `name`, e.g. in a
+    worker thread of that step; the step name does not cross threads.
+    """
+    previous, _step.name = current_step(), name
+
+    try:
+        yield
+    finally:
+        _step.name = previous
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[Union[Span, _Disabled]]:
+    """ Time the enclosed block as phase `name` of the current step. """
+    if _spans is None:
+        yield _DISABLED
+        return
+
+    span = Span(name, current_step())
+    span.start = time.perf_counter()
+    cpu = time.process_time()
+
+    try:
+        yield span
+    finally:
+        span.wall = time.perf_counter() - span.start
+        # process_time() counts every thread, which overlapping phases share
+        span.cpu = time.process_time() - cpu
+        _spans.append(span)
+
+@contextlib.contextmanager
+def step(name: str) -> Iterator[List[Span]]:
+    """
+    Attribute the phases inside to step `name`, and collect the spans
+    recorded meanwhile into the yielded list instead of the global one, so
+    a worker process can send just those back.
+    """
+    global _spans
+
+    if _spans is None:
+        yield []
+        return
+
+    outer, _spans = _spans, []
+    previous, _step.name = current_step(), name
+    collected = _spans
+
+    try:
+        with phase('step'):
+            yield collected
+    finally:
+        _spans, _step.name = outer, previous
+
+def tree_size(path: Path) -> Tuple[int, int]:
+    """ Total size and number of files below `path`, for phases that copy whole trees. """
+    size = files = 0
+
+    for root, _, names in os.walk(path):
+        for name in names:
+            size += os.path.getsize(os.path.join(root, name))
+            files += 1
+
+    return size, files
+
+def summary(spans_: List[Span]) -> Dict[str, Dict[str, dict]]:
+    """ Totals per step and phase. """
+    totals = {}
+
+    for span in spans_:
+        entry = totals.setdefault(span.step, {}).setdefault(span.name, {
+            'count': 0, 'wall': 0.0, 'cpu': 0.0, 'bytes': 0, 'files': 0
+        })
+
+        entry['count'] += 1
+        entry['wall'] += span.wall
+        entry['cpu'] += span.cpu
+        entry['bytes'] += span.bytes
+        entry['files'] += span.files
+
+    for phases in totals.values():
+        for entry in phases.values():
+            entry['throughput'] = entry['bytes'] / entry['wall'] if entry['wall'] and entry['bytes'] else None
+
+    return totals
+
+def print_summary(spans_: List[Span]) -> None:
+    print('{0:<24} {1:>9} {2:>9} {3:>7} {4:>11} {5:>11}'.format('phase', 'wall (s)', 'cpu (s)', 'files', 'MiB', 'MiB/s'))
+
+    for step_name, phases in summary(spans_).items():
+        print(step_name or '-')
+
+        for name, entry in sorted(phases.items(), key=lambda x: -x[1]['wall']):
+            throughput = entry['throughput']
+
+            print('  {0:<22} {1:>9.3f} {2:>9.3f} {3:>7} {4:>11.1f} {5:>11}'.format(
+                name, entry['wall'], entry['cpu'], entry['files'], entry['bytes'] / (1 << 20),
+                '-' if throughput is None else '{0:.1f}'.format(throughput / (1 << 20))
+            ))
+
+def write_json(spans_: List[Span], file: Path) -> None:
+    with open(file, 'w') as fp:
+        json.dump({
+            'created': time.time(),
+            'summary': summary(spans_),
+            'spans': [x.as_dict() for x in spans_]
+        }, fp, indent=4)
+
+def write_trace(spans_: List[Span], file: Path) -> None:
+    """ Chrome trace event format, for chrome://tracing or Perfetto. """
+    origin = min((x.start for x in spans_), default=0)
+
+    events = [{
+        'name': x.name,
+        'cat': x.step or 'manager',
+        'ph': 'X',
+        'ts': (x.start - origin) * 1e6,
+        'dur': x.wall * 1e6,
+        'pid': x.pid,
+        'tid': x.tid,
+        'args': {'step': x.step, 'cpu': x.cpu, 'bytes': x.bytes, 'files': x.files}
+    } for x in spans_]
+
+    with open(file, 'w') as fp:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import os, re, time, shutil, threading
+
+from pathlib import Path
+from typing import (
+    Iterable,
+    List,
+    Union
+)
+
+from .index import MissionIndex
+
+_DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+
+def parse_duration(duration: Union[int, float, str, None]) -> Union[float, None]:
+    """ Parse a duration such as 3600, '90m' or '7d' into seconds. """
+    if duration is None or isinstance(duration, (int, float)): return duration
+
+    match = re.fullmatch(r'\s*([0-9]+(?:\.[0-9]+)?)\s*([smhdw]?)\s*', duration.lower())
+
+    if match is None:
+        raise Exception(f'Invalid duration {duration}')
+
+    return float(match.group(1)) * _DURATION_UNITS[match.group(2)]
+
+class RetentionPolicy:
+    """
+    Which versioned outputs to keep. A version survives if it is one of the
+    `keep_last` newest, if it is younger than `max_age`, if it is the current
+    one or if it is protected (e.g. the target of a link). With neither
+    `keep_last` nor `max_age` set, nothing is removed.
+    """
+    def __init__(self, keep_last: int = 0, max_age: Union[int, float, str, None] = None) -> None:
+        self.keep_last = int(keep_last or 0)
+        self.max_age = parse_duration(max_age)
+
+    @classmethod
+    def from_options(cls, opts: Union[dict, int, None]) -> Union[RetentionPolicy, None]:
+        if not opts: return None
+
+        if isinstance(opts, int):
+            opts = {'keep_last': opts}
+
+        return cls(opts.get('keep_last', 0), opts.get('max_age'))
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.keep_last) or self.max_age is not None
+
+    def select(self, index: MissionIndex, protected: Iterable[Path] = ()) -> List[Path]:
+        """ Outputs in `index` that this policy would remove, oldest first. """
+        if not self.enabled: return []
+
+        versions = index.scan()
+        current = index.current
+        protected = {os.path.realpath(x) for x in protected}
+        kept = set(versions[-self.keep_last:]) if self.keep_last else set()
+        now = time.time()
+        expired = []
+
+        for idx in versions:
+            path = index.path(idx)
+
+            if idx in kept or idx >= current: continue
+            if os.path.realpath(path) in protected: continue
+
+            try:
+                age = now - os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+
+            if self.max_age is not None and age <= self.max_age: continue
+
+            expired.append(path)
+
+        return expired
+
+def prune(index: MissionIndex, policy: RetentionPolicy, protected: Iterable[Path] = ()) -> List[Path]:
+    removed = []
+
+    for path in policy.select(index, protected):
+        try:
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            continue
+
+        removed.append(path)
+
+    return removed
+
+def prune_async(index: MissionIndex, policy: RetentionPolicy, protected: Iterable[Path] = ()) -> threading.Thread:
+    """
+    Prune on a background thread. The thread is not a daemon, so the
+    interpreter waits for it before exiting rather than leaving a
+    half-deleted output behind.
+    """
+    protected = list(protected)
+    thread = threading.Thread(target=prune, args=(index, policy, protected), name=f'prune-{index.prefix}')
+    thread.start()
+
+    return thread
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import time
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    wait
+)
+from typing import (
+    Any,
+    List,
+    NamedTuple,
+    Set
+)
+
+from .builder import Builder, Linker
+from . import profiling
+
+class StepResult(NamedTuple):
+    name: str
+    elapsed: float
+    result: Any
+    spans: list = []
+
+def run_step(step: dict, profile: bool = False) -> StepResult:
+    step = dict(step)
+    name = step.get('name', '')
+    type_ = step.pop('type').lower()
+    step.pop('depends_on', None)
+
+    # A spawned worker does not inherit the parent's profiling state
+    if profile and not profiling.enabled():
+        profiling.enable()
+
+    start = time.perf_counter()
+
+    with profiling.step(name) as spans:
+        if type_ == 'build':
+            result = Builder(step).build()
+        elif type_ == 'link':
+            result = Linker(**step).run()
+        else:
+            raise Exception(f'Unknown type {type_}')
+
+    return StepResult(name, time.perf_counter() - start, result, spans)
+
+class Scheduler:
+    """
+    Runs build/link steps in dependency order.
+
+    A step that declares `depends_on` (a name or list of names, possibly
+    empty) only waits for those steps; a step without it waits for every
+    step listed before it, which keeps the old serial behaviour. Names that
+    are not part of this run are considered satisfied, so a subset of the
+    steps can be built on its own.
+
+    With more than one job, ready steps run concurrently in a process pool
+    (packing is CPU bound, and the packer changes the working directory).
+    The first failure stops any further steps from being started.
+    """
+    def __init__(self, steps: List[dict], jobs: int = 1) -> None:
+        self.steps = list(steps)
+        self.jobs = max(1, int(jobs))
+        self.deps = self._resolve_deps()
+        self.order = self._sort()
+
+    def _name(self, idx: int) -> str:
+        return self.steps[idx].get('name', f'#{idx}')
+
+    def _resolve_deps(self) -> List[Set[int]]:
+        names = {}
+
+        for idx, step in enumerate(self.steps):
+            if (name := step.get('name')) is None: continue
+
+            if name in names:
+                raise Exception(f'Duplicate step name {name}')
+
+            names[name] = idx
+
+        deps = []
+
+        for idx, step in enumerate(self.steps):
+            if 'depends_on' not in step:
+                deps.append(set(range(idx)))
+                continue
+
+            depends_on = step['depends_on']
+
+            if isinstance(depends_on, str):
+                depends_on = [depends_on]
+
+            deps.append({names[x] for x in depends_on if x in names})
+
+        return deps
+
+    def _sort(self) -> List[int]:
+        pending = {i: set(x) for i, x in enumerate(self.deps)}
+        order = []
+
+        while pending:
+            ready = [i for i, x in pending.items() if not x]
+
+            if not ready:
+                raise Exception('Circular step dependencies between {0}'.format(
+                    ', '.join(self._name(x) for x in pending)
+                ))
+
+            idx = min(ready)
+            del pending[idx]
+            order.append(idx)
+
+            for x in pending.values():
+                x.discard(idx)
+
+        return order
+
+    def _report(self, result: StepResult) -> StepResult:
+        print(f'{result.name}: done in {result.elapsed:.2f}s')
+        profiling.add(result.spans)
+
+        return result
+
+    def _run_serial(self) -> List[StepResult]:
+        return [self._report(run_step(self.steps[i], profiling.enabled())) for i in self.order]
+
+    def _run_parallel(self) -> List[StepResult]:
+        pending = {i: set(x) for i, x in enumerate(self.deps)}
+        running, results = {}, []
+
+        with ProcessPoolExecutor(self.jobs) as executor:
+            while pending or running:
+                for idx in [i for i in self.order if i in pending and not pending[i]]:
+                    del pending[idx]
+                    running[executor.submit(run_step, self.steps[idx], profiling.enabled())] = idx
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    idx = running.pop(future)
+
+                    try:
+                        result = future.result()
+                    except BaseException:
+                        print(f'{self._name(idx)}: failed, waiting for running steps to finish')
+
+                        for x in running:
+                            x.cancel()
+
+                        raise
+
+                    results.append(self._report(result))
+
+                    for x in pending.values():
+                        x.discard(idx)
+
+        return results
+
+    def run(self) -> List[StepResult]:
+        start = time.perf_counter()
+
+        if self.jobs == 1 or len(self.steps) < 2:
+            results = self._run_serial()
+        else:
+            results = self._run_parallel()
+
+        print('Finished {0} steps in {1:.2f}s'.format(len(results), time.perf_counter() - start))
+
+        return results
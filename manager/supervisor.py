@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import os, time, signal, asyncio, subprocess
+
+from pathlib import Path
+from typing import (
+    Dict,
+    List,
+    NamedTuple,
+    Union
+)
+
+RESTART_POLICIES = ('on-failure', 'always', 'never')
+
+class InstanceSpec(NamedTuple):
+    name: str
+    argv: List[str]
+    cwd: Union[Path, None] = None
+    # CPUs the instance is pinned to, all of them if None
+    cpus: Union[List[int], None] = None
+    # Seconds to wait before the first start, e.g. for headless clients
+    delay: float = 0
+
+class Supervisor:
+    """
+    Runs several instances from one process and keeps them running.
+
+    An instance that exits is started again (with `policy` 'on-failure',
+    only if it exited with an error), after a delay that starts at
+    `backoff` and doubles with each restart up to `max_backoff`. It is
+    reset once an instance stayed up for `reset_after` seconds. SIGINT and
+    SIGTERM stop every instance: each is terminated, and killed if it is
+    still running after `stop_timeout` seconds.
+    """
+    def __init__(self, specs: List[InstanceSpec], policy: str = 'on-failure', backoff: float = 1.0,
+            max_backoff: float = 60.0, reset_after: float = 60.0, stop_timeout: float = 30.0) -> None:
+        if policy not in RESTART_POLICIES:
+            raise Exception('Invalid restart policy {0}, expected one of {1}'.format(policy, ', '.join(RESTART_POLICIES)))
+
+        if len({x.name for x in specs}) != len(specs):
+            raise Exception('Instance names must be unique')
+
+        self.specs = specs
+        self.policy = policy
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.reset_after = reset_after
+        self.stop_timeout = stop_timeout
+
+        self.processes: Dict[str, asyncio.subprocess.Process] = {}
+        self.restarts = {x.name: 0 for x in specs}
+
+        self._stopping: Union[asyncio.Event, None] = None
+
+    def stop(self) -> None:
+        if self._stopping is None or self._stopping.is_set(): return
+
+        print('Stopping {0} instances'.format(len(self.processes)), flush=True)
+        self._stopping.set()
+
+    async def _sleep(self, seconds: float) -> None:
+        """ Sleep, returning early when stopping. """
+        try:
+            await asyncio.wait_for(self._stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _start(self, spec: InstanceSpec) -> asyncio.subprocess.Process:
+        kwargs = {}
+
+        if os.name == 'posix':
+            # Keeps a Ctrl-C in the terminal from reaching the instances
+            # directly, so they are stopped by us and never seen as crashed
+            kwargs['start_new_session'] = True
+
+        if spec.cpus and hasattr(os, 'sched_setaffinity'):
+            cpus = set(spec.cpus) & os.sched_getaffinity(0)
+
+            if (missing := set(spec.cpus) - cpus):
+                print('{0}: CPUs {1} are not available'.format(spec.name, ', '.join(map(str, sorted(missing)))), flush=True)
+
+            if cpus:
+                # Pinned before exec, so every thread of the instance inherits it
+                kwargs['preexec_fn'] = lambda: os.sched_setaffinity(0, cpus)
+        elif spec.cpus:
+            print(f'{spec.name}: CPU pinning is not supported here', flush=True)
+
+        return await asyncio.create_subprocess_exec(*spec.argv, cwd=spec.cwd, **kwargs)
+
+    async def _terminate(self, name: str, proc: asyncio.subprocess.Process) -> None:
+        if proc.returncode is not None: return
+
+        proc.terminate()
+
+        try:
+            await asyncio.wait_for(proc.wait(), self.stop_timeout)
+        except asyncio.TimeoutError:
+            print(f'{name}: still running after {self.stop_timeout}s, killing', flush=True)
+            proc.kill()
+
+            await proc.wait()
+
+    async def _supervise(self, spec: InstanceSpec) -> None:
+        delay = self.backoff
+
+        if spec.delay:
+            await self._sleep(spec.delay)
+
+        while not self._stopping.is_set():
+            started = time.monotonic()
+
+            try:
+                proc = await self._start(spec)
+            except (OSError, subprocess.SubprocessError) as e:
+                print(f'{spec.name}: could not start ({e})', flush=True)
+                code = None
+            else:
+                self.processes[spec.name] = proc
+                print(f'{spec.name}: started (pid {proc.pid})', flush=True)
+
+                # stop() may have come while starting
+                if self._stopping.is_set():
+                    await self._terminate(spec.name, proc)
+
+                code = await proc.wait()
+                del self.processes[spec.name]
+
+            if self._stopping.is_set():
+                print(f'{spec.name}: stopped', flush=True)
+                break
+
+            if self.policy == 'never' or (code == 0 and self.policy == 'on-failure'):
+                print(f'{spec.name}: exited with {code}', flush=True)
+                break
+
+            if time.monotonic() - started >= self.reset_after:
+                delay = self.backoff
+
+            self.restarts[spec.name] += 1
+            print(f'{spec.name}: exited with {code}, restarting in {delay:.1f}s', flush=True)
+
+            await self._sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+    async def run(self) -> None:
+        """ Run until every instance exited for good, or until stopped. """
+        loop = asyncio.get_event_loop()
+        self._stopping = asyncio.Event()
+        handled = []
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+                handled.append(signum)
+            except (NotImplementedError, RuntimeError):
+                # No loop signal handlers on Windows
+                signal.signal(signum, lambda *_: loop.call_soon_threadsafe(self.stop))
+
+        tasks = [asyncio.ensure_future(self._supervise(x)) for x in self.specs]
+        stopping = asyncio.ensure_future(self._stopping.wait())
+
+        try:
+            pending = set(tasks)
+
+            while pending and not self._stopping.is_set():
+                _, pending = await asyncio.wait(pending | {stopping}, return_when=asyncio.FIRST_COMPLETED)
+                pending.discard(stopping)
+
+            if self._stopping.is_set():
+                await asyncio.gather(*(self._terminate(k, v) for k, v in list(self.processes.items())))
+
+            await asyncio.gather(*tasks)
+        finally:
+            stopping.cancel()
+
+            for signum in handled:
+                loop.remove_signal_handler(signum)
@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+import os, time, errno, ctypes, select, struct
+
+from pathlib import Path
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Set,
+    Tuple,
+    Union
+)
+
+from .builder import BuilderOptions, process_steps
+from .const import IS_LINUX
+from .scheduler import Scheduler
+
+# linux/inotify.h
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# IN_MODIFY is left out on purpose, it fires for every write() call
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+
+EVENT = struct.Struct('iIII')
+
+def _is_under(path: Path, roots: Iterable[Path]) -> bool:
+    return any(path == x or x in path.parents for x in roots)
+
+class PollingWatcher:
+    """ Detects changes by comparing (mtime, size) snapshots of every file under the roots. """
+    def __init__(self, roots: List[Path], excluded: List[Path] = [], interval: float = 1.0) -> None:
+        self.roots = roots
+        self.excluded = excluded
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self) -> Dict[Path, Tuple[int, int]]:
+        snapshot = {}
+
+        def walk(path: Path) -> None:
+            if _is_under(path, self.excluded): return
+
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return
+
+            if path.is_dir():
+                for entry in os.scandir(path):
+                    walk(Path(entry))
+            else:
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+
+        for root in self.roots:
+            walk(root)
+
+        return snapshot
+
+    def wait(self, timeout: Union[float, None] = None) -> Set[Path]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            delay = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+
+            if delay > 0:
+                time.sleep(delay)
+
+            snapshot = self._scan()
+            changed = {
+                x for x in snapshot.keys() | self._snapshot.keys()
+                    if snapshot.get(x) != self._snapshot.get(x)
+            }
+            self._snapshot = snapshot
+
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self) -> None:
+        pass
+
+class InotifyWatcher:
+    """
+    Recursive watch on the roots through inotify. New directories are
+    watched as they appear; a queue overflow reports every root as changed.
+    """
+    def __init__(self, roots: List[Path], excluded: List[Path] = []) -> None:
+        self.roots = roots
+        self.excluded = excluded
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._dirs = {}
+
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        try:
+            for root in roots:
+                self._add_tree(root if root.is_dir() else root.parent)
+        except BaseException:
+            self.close()
+
+            raise
+
+    def _add_tree(self, path: Path) -> Set[Path]:
+        """ Watch `path` and every directory below it; returns the files found. """
+        if _is_under(path, self.excluded): return set()
+
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+
+        if wd < 0:
+            err = ctypes.get_errno()
+
+            if err in (errno.ENOENT, errno.ENOTDIR): return set()
+
+            # ENOSPC means fs.inotify.max_user_watches has been reached
+            raise OSError(err, os.strerror(err), os.fspath(path))
+
+        self._dirs[wd] = path
+        found = set()
+
+        try:
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            return found
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                found |= self._add_tree(Path(entry))
+            else:
+                found.add(Path(entry))
+
+        return found
+
+    def _read(self) -> Set[Path]:
+        changed = set()
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+                offset += EVENT.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    changed |= set(self.roots)
+                    continue
+
+                if mask & IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    continue
+
+                if (parent := self._dirs.get(wd)) is None: continue
+
+                path = parent.joinpath(os.fsdecode(name)) if name else parent
+
+                if _is_under(path, self.excluded): continue
+
+                changed.add(path)
+
+                # Files may have been created before the watch was in place
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    changed |= self._add_tree(path)
+
+    def wait(self, timeout: Union[float, None] = None) -> Set[Path]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+
+            if ready and (changed := self._read()):
+                return changed
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def create_watcher(roots: List[Path], excluded: List[Path] = [], poll: bool = False) -> Union[InotifyWatcher, PollingWatcher]:
+    if IS_LINUX and not poll:
+        try:
+            return InotifyWatcher(roots, excluded)
+        except (OSError, AttributeError) as e:
+            print(f'inotify unavailable ({e}), falling back to polling')
+
+    return PollingWatcher(roots, excluded)
+
+def step_roots(step: dict) -> Tuple[List[Path], List[Path]]:
+    """ Paths a build step reads from, and the paths it writes to. """
+    opts = BuilderOptions(**step)
+    roots = [opts.source_dir.joinpath(x) for x, _ in opts.paths]
+
+    for name in opts.variants:
+        variant = opts.variant(name)
+
+        if variant.has_includes:
+            roots.extend(variant.source_dir.joinpath(x) for x, _ in variant.paths)
+
+    return [Path(os.path.abspath(x)) for x in roots], [Path(os.path.abspath(x)) for x in opts.excluded_paths]
+
+def affected_steps(steps: List[dict], built: Set[int]) -> List[dict]:
+    """ The steps in `built` plus the link steps that depend on them, in order. """
+    deps = Scheduler(steps).deps
+    selected = set(built)
+
+    for idx, step in enumerate(steps):
+        if step['type'].lower() == 'link' and deps[idx] & selected:
+            selected.add(idx)
+
+    return [x for i, x in enumerate(steps) if i in selected]
+
+def watch(steps: List[dict], jobs: int = 1, debounce: float = 0.3, poll: bool = False) -> None:
+    """
+    Rebuild the build steps whose sources change, plus the link steps that
+    depend on them, until interrupted. Builds are forced to be incremental,
+    and bursts of events are merged until `debounce` seconds pass quietly.
+    """
+    steps = [dict(x) for x in steps]
+    roots, excluded = {}, []
+
+    for idx, step in enumerate(steps):
+        if step['type'].lower() != 'build': continue
+
+        step['output'] = {**step.get('output', {}), 'incremental': True}
+        roots[idx], step_excluded = step_roots(step)
+        excluded.extend(step_excluded)
+
+    watcher = create_watcher(sorted({x for v in roots.values() for x in v}), excluded, poll)
+    print('Watching {0} steps ({1})'.format(len(roots), type(watcher).__name__))
+
+    try:
+        while True:
+            changed = watcher.wait()
+            first = time.perf_counter()
+
+            while (more := watcher.wait(debounce)):
+                changed |= more
+
+            built = {
+                idx for idx, paths in roots.items()
+                    if any(_is_under(x, paths) or x in paths for x in changed)
+            }
+
+            if not built: continue
+
+            selected = affected_steps(steps, built)
+            print('{0} changed paths, rebuilding {1}'.format(len(changed), ', '.join(x.get('name', '') for x in selected)))
+
+            try:
+                process_steps(selected, jobs)
+            except Exception as e:
+                print(f'Rebuild failed: {e}')
+                continue
+
+            print('Rebuilt in {0:.2f}s after the first change'.format(time.perf_counter() - first))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
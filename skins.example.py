@@ -4,6 +4,7 @@ from pathlib import Path
 from collections import namedtuple
 from dotenv import load_dotenv
 from armaconfig import Config, decode, encode, Encoder
+from manager.index import MissionIndex
 
 load_dotenv()
 
@@ -57,18 +58,9 @@ class Mission(_Mission): #namedtuple('Mission', ['base', 'textures', 'config']))
         return Config('CfgWhitelistedGangs')
 
     @classmethod
-    def current(cls, prefix='mission_'):
-        highest = -1
-
-        for _, dirs, _ in os.walk(CACHE_DIR):
-            for d in dirs:
-                if match := re.match(re.compile(prefix + '(\\d*)'), d):
-                    idx = int(match.group(1))
-
-                    if idx > highest:
-                        highest = idx
-
-        path = CACHE_DIR.joinpath(prefix + str(highest))
+    def current(cls, name='mission'):
+        index = MissionIndex(CACHE_DIR, name)
+        path = index.path(index.current)
 
         return cls(path, path.joinpath('data', 'textures'), path.joinpath('PHX', 'Configuration'))
 
@@ -0,0 +1,42 @@
+import hashlib
+
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from manager import pbo
+
+def read_pbo(path: Path) -> Dict[str, bytes]:
+    """ Contents of every entry of a PBO, checking its SHA1 trailer. """
+    with open(path, 'rb') as fp:
+        headers, offset = pbo.read_headers(fp)
+        files = {}
+
+        for header in headers:
+            data = fp.read(header.data_size)
+
+            if header.method == pbo.METHOD_COMPRESSED:
+                data = pbo.lzss_decompress(data, header.original_size)
+
+            files[header.name] = data
+
+        end = fp.tell()
+        trailer = fp.read()
+
+    with open(path, 'rb') as fp:
+        assert trailer == b'\0' + hashlib.sha1(fp.read(end)).digest()
+
+    return files
+
+def write_tree(root: Path, files: Dict[str, str]) -> Path:
+    for name, text in files.items():
+        path = root.joinpath(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+
+    return root
+
+@pytest.fixture
+def tree(tmp_path):
+    return lambda files, name='src': write_tree(tmp_path.joinpath(name), files)
@@ -0,0 +1,129 @@
+import os
+
+from pathlib import Path
+
+from manager.builder import Builder
+
+from conftest import read_pbo
+
+def build(src: Path, out: Path, tmp: str = 'tmp', incremental: bool = True, **output) -> Path:
+    return Builder({
+        'source_dir': os.fspath(src),
+        'output': {
+            'dir': os.fspath(out),
+            'tmp_dir': os.fspath(out.parent.joinpath(tmp)),
+            'incremental': incremental,
+            'binarizer': 'pbostream',
+            **output
+        }
+    }).build()
+
+def edit(path: Path, text: str) -> None:
+    """ Rewrite a file with a distinct mtime, so that a same-size edit is seen. """
+    stat = path.stat()
+    path.write_text(text)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2_000_000_000))
+
+def test_incremental_matches_full_build(tree, tmp_path):
+    src = tree({'a.sqf': 'a', 'b/c.sqf': 'c', 'd.sqf': 'd'})
+    out = tmp_path.joinpath('out')
+
+    build(src, out)
+    edit(src.joinpath('a.sqf'), 'A changed')
+    src.joinpath('d.sqf').unlink()
+    src.joinpath('e.sqf').write_text('e')
+
+    incremental = read_pbo(build(src, out))
+    full = read_pbo(build(src, tmp_path.joinpath('full'), tmp='full_tmp', incremental=False))
+
+    assert incremental == full == {'a.sqf': b'A changed', 'b\\c.sqf': b'c', 'e.sqf': b'e'}
+
+def test_delta_ignores_artifacts_outside_the_manifest(tree, tmp_path):
+    src = tree({'x.sqf': 'xxxx', 'y.sqf': 'yyyy'})
+    out = tmp_path.joinpath('out')
+
+    build(src, out)
+
+    # A plain build into the same directory is newer than the artifact the
+    # manifest describes, so it must not be used as the delta base
+    edit(src.joinpath('x.sqf'), 'XXXX')
+    build(src, out, incremental=False)
+    edit(src.joinpath('x.sqf'), 'xxxx')
+    edit(src.joinpath('y.sqf'), 'YYYY')
+
+    assert read_pbo(build(src, out)) == {'x.sqf': b'xxxx', 'y.sqf': b'YYYY'}
+
+def test_staging_after_manifest_reset(tree, tmp_path):
+    src = tree({'keep.sqf': 'keep', 'stale.sqf': 'stale'})
+
+    build(src, tmp_path.joinpath('out'))
+    src.joinpath('stale.sqf').unlink()
+
+    # A new output directory has no manifest, while the staged tree is
+    # shared; files removed in between must not be packed again
+    built = build(src, tmp_path.joinpath('other'))
+
+    assert read_pbo(built) == {'keep.sqf': b'keep'}
+    assert not tmp_path.joinpath('tmp', 'stale.sqf').exists()
+
+def test_default_tmp_dir_inside_source(tree, tmp_path):
+    src = tree({'a.sqf': 'a', 'b.sqf': 'b'})
+
+    def build_default(**output) -> Path:
+        return Builder({
+            'source_dir': os.fspath(src),
+            'output': {'dir': os.fspath(tmp_path.joinpath('out')), 'incremental': True, 'binarizer': 'pbostream', **output}
+        }).build()
+
+    build_default()
+    edit(src.joinpath('a.sqf'), 'A')
+
+    # The staged tree and its manifest live in source_dir, and are never sources
+    assert read_pbo(build_default()) == {'a.sqf': b'A', 'b.sqf': b'b'}
+
+    edit(src.joinpath('b.sqf'), 'B')
+    assert read_pbo(build_default(staging='direct')) == {'a.sqf': b'A', 'b.sqf': b'B'}
+
+def test_default_missions_dir_inside_source(tree):
+    src = tree({'a.sqf': 'a'})
+    opts = {'source_dir': os.fspath(src), 'output': {'binarizer': 'pbostream'}}
+
+    first = Builder(opts).build()
+    second = Builder(opts).build()
+
+    # Earlier builds and the output index are not packed into later ones
+    assert first.parent == second.parent == src.joinpath('missions')
+    assert read_pbo(first) == read_pbo(second) == {'a.sqf': b'a'}
+
+def test_up_to_date_build_restores_links(tree, tmp_path):
+    src = tree({'a.sqf': 'a'})
+    link = tmp_path.joinpath('deployed', 'mission.pbo')
+    opts = {
+        'source_dir': os.fspath(src),
+        'output': {'dir': os.fspath(tmp_path.joinpath('out')), 'incremental': True, 'binarizer': 'pbostream', 'links': [os.fspath(link)]}
+    }
+
+    built = Builder(opts).build()
+    link.unlink()
+
+    assert Builder(opts).estimate()[0].links == [(link, 'create')]
+    assert Builder(opts).build() == built
+    assert os.path.realpath(link) == os.path.realpath(built)
+    assert Builder(opts).estimate()[0].links == [(link, 'unchanged')]
+
+def test_variant_estimate_matches_direct_staging(tree, tmp_path):
+    src = tree({'a.sqf': 'a' * 100, 'b.sqf': 'b' * 50})
+    opts = {
+        'source_dir': os.fspath(src),
+        'variants': ['one', 'two'],
+        'output': {'dir': os.fspath(tmp_path.joinpath('out')), 'binarizer': 'pbostream', 'staging': 'copy'}
+    }
+
+    estimates = Builder(opts).estimate()
+
+    # Variants always pack from the file map, so nothing is copied
+    assert [(x.name, x.copy_size, x.pack_size) for x in estimates] == [('mission_one', 0, 150), ('mission_two', 0, 150)]
+
+    built = Builder(opts).build()
+    assert not tmp_path.joinpath('tmp').exists() and not src.joinpath('tmp').exists()
+    assert all(read_pbo(x) == {'a.sqf': b'a' * 100, 'b.sqf': b'b' * 50} for x in built.values())
@@ -0,0 +1,37 @@
+import os
+
+from manager.cache import BuildCache
+
+def test_lookups_leave_the_entry_alone(tmp_path):
+    artifact = tmp_path.joinpath('mission_0.pbo')
+    artifact.write_bytes(b'pbo')
+    os.utime(artifact, ns=(0, 1_000_000_000))
+
+    cache = BuildCache(tmp_path.joinpath('cache'), strategy='hardlink')
+    cache.put('a', artifact, '.pbo')
+    cache.put('b', artifact, '.pbo')
+    before = artifact.stat().st_mtime_ns
+
+    # Entries may share the artifact's inode, whose mtime the manifest checks
+    assert cache.get('a', '.pbo') is not None
+    assert artifact.stat().st_mtime_ns == before
+
+    os.utime(cache.path.joinpath('.b.pbo.used'), (0, 0))
+    assert [x.key for x in cache.entries()] == ['b', 'a']
+    assert [x.key for x in cache.prune(max_size=len(b'pbo'))] == ['b']
+    assert sorted(os.listdir(cache.path)) == ['.a.pbo.used', 'a.pbo']
+
+def test_entries_are_not_linked_to_sources(tmp_path):
+    out = tmp_path.joinpath('mission_0')
+    out.mkdir()
+    out.joinpath('a.sqf').write_text('original')
+
+    cache = BuildCache(tmp_path.joinpath('cache'), strategy='hardlink')
+    entry = cache.put('a', out)
+
+    # An in-place edit of a source that the output was hardlinked to
+    with open(out.joinpath('a.sqf'), 'w') as fp:
+        fp.write('edited')
+
+    assert entry.joinpath('a.sqf').read_text() == 'original'
+    assert cache.get('missing') is None
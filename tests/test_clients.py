@@ -0,0 +1,133 @@
+import os, sys, json
+
+import pytest
+
+from manager.clients import ArmaClient, SteamBatch
+
+# Stands in for steamcmd: logs its commands and "installs" the server
+FAKE_STEAMCMD = '''#!{python}
+import os, sys, json
+from pathlib import Path
+
+args = ' '.join(sys.argv[1:]).split()
+state = Path(__file__).with_name('steamcmd.json')
+calls = json.loads(state.read_text()) if state.exists() else []
+calls.append(args)
+state.write_text(json.dumps(calls))
+install_dir = None
+
+for idx, arg in enumerate(args):
+    if arg == '+force_install_dir':
+        install_dir = Path(args[idx + 1])
+    elif arg == '+app_update':
+        app_id = args[idx + 1]
+        install_dir.joinpath('steamapps').mkdir(parents=True, exist_ok=True)
+        install_dir.joinpath('addons').mkdir(exist_ok=True)
+        install_dir.joinpath('addons', 'a.pbo').write_text('data')
+        install_dir.joinpath('arma3server').write_text('exe')
+        install_dir.joinpath('steamapps', 'appmanifest_' + app_id + '.acf').write_text(
+            '"AppState"\\n{{\\n\\t"buildid"\\t\\t"42"\\n}}\\n'
+        )
+        print(" Success! App '" + app_id + "' fully installed.")
+'''
+
+@pytest.fixture
+def steamcmd(tmp_path):
+    exe = tmp_path.joinpath('fake', 'steamcmd')
+    exe.parent.mkdir()
+    exe.write_text(FAKE_STEAMCMD.format(python=sys.executable))
+    exe.chmod(0o755)
+
+    def calls() -> list:
+        log = exe.with_name('steamcmd.json')
+
+        return json.loads(log.read_text()) if log.exists() else []
+
+    opts = {'path': os.fspath(exe.parent), 'login': ['anonymous', ''], 'executable': os.fspath(exe)}
+
+    return opts, calls
+
+def install(client: ArmaClient, steamcmd: dict) -> None:
+    batch = SteamBatch(steamcmd)
+    client.queue(batch)
+    batch.run(echo=False).check()
+
+def validated(calls: list) -> bool:
+    return 'validate' in calls[-1]
+
+def test_install_validates_only_on_drift(steamcmd, tmp_path):
+    opts, calls = steamcmd
+    client = ArmaClient(path=tmp_path.joinpath('arma3'))
+
+    install(client, opts)
+    assert len(calls()) == 1 and not validated(calls())
+
+    # Up to date: a plain app_update, in the same session
+    install(client, opts)
+    assert len(calls()) == 2 and not validated(calls())
+
+    client.path.joinpath('addons', 'a.pbo').write_text('tampered')
+    install(client, opts)
+    assert validated(calls())
+
+    install(client, opts)
+    assert not validated(calls())
+
+def test_excluded_files_are_not_drift(steamcmd, tmp_path):
+    opts, calls = steamcmd
+    client = ArmaClient(path=tmp_path.joinpath('arma3'))
+    install(client, opts)
+
+    for name in ('mpmissions/test.Altis.pbo', 'profiles/server.Arma3Profile', 'keys/a.bikey', 'server.cfg'):
+        path = client.path.joinpath(name)
+        path.parent.mkdir(exist_ok=True)
+        path.write_text('written')
+        install(client, opts)
+        path.write_text('rewritten')
+        install(client, opts)
+
+        assert not validated(calls()), name
+
+def test_install_exclude_is_configurable(steamcmd, tmp_path):
+    opts, calls = steamcmd
+    client = ArmaClient(path=tmp_path.joinpath('arma3'), install_exclude=['addons/*'])
+    install(client, opts)
+
+    client.path.joinpath('addons', 'a.pbo').write_text('tampered')
+    install(client, opts)
+    assert not validated(calls())
+
+    # No longer excluded: the config is drift again
+    client.path.joinpath('server.cfg').write_text('a')
+    install(client, opts)
+    client.path.joinpath('server.cfg').write_text('b')
+    install(client, opts)
+    assert validated(calls())
+
+def test_existing_install_is_validated_once(steamcmd, tmp_path):
+    opts, calls = steamcmd
+    client = ArmaClient(path=tmp_path.joinpath('arma3'))
+    install(client, opts)
+
+    os.remove(client.path.joinpath('.manager-manifest.json'))
+    install(client, opts)
+    assert validated(calls())
+
+    install(client, opts)
+    assert not validated(calls())
+
+def instance_args(spec) -> dict:
+    return dict(x[1:].partition('=')[::2] for x in spec.argv[1:])
+
+@pytest.mark.parametrize('server_port, expected', [(None, '2402'), ('2500', '2500')])
+def test_instances_connect_to_the_first_server(tmp_path, server_port, expected):
+    server = {'name': 'server', **({'port': server_port} if server_port else {})}
+    client = ArmaClient(path=tmp_path, executable='arma3server', port=2402, instances=[
+        {'name': 'hc', 'headless': True}, server, {'name': 'second'}
+    ])
+    hc, server, second = (instance_args(x) for x in client.instances())
+
+    assert server['port'] == expected
+    assert second['port'] == str(int(expected) + 10)
+    assert hc['port'] == expected and hc['connect'] == '127.0.0.1' and 'client' in hc
+    assert hc['profiles'] == os.fspath(tmp_path.joinpath('profiles', 'hc'))
@@ -0,0 +1,50 @@
+import os, sys, time, socket, subprocess
+
+from pathlib import Path
+
+import pytest
+
+from manager.daemon import request
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='Unix sockets')
+
+ROOT = Path(__file__).resolve().parents[1]
+
+def start(path: Path) -> subprocess.Popen:
+    proc = subprocess.Popen(
+        [sys.executable, '-c', 'import sys; from manager.daemon import Daemon; Daemon(sys.argv[1]).serve()', os.fspath(path)],
+        cwd=path.parent, env={**os.environ, 'PYTHONPATH': os.fspath(ROOT)},
+        stdout=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 10
+
+    while request(path, {'command': 'status'}) is None:
+        assert proc.poll() is None and time.monotonic() < deadline, 'daemon did not start'
+        time.sleep(0.05)
+
+    return proc
+
+@pytest.mark.parametrize('attempt', range(6))
+def test_stop_replies(tmp_path, attempt):
+    path = tmp_path.joinpath('d.sock')
+    proc = start(path)
+
+    try:
+        assert request(path, {'command': 'stop'}) == {'status': 'ok'}
+        assert proc.wait(10) == 0
+        assert not path.exists()
+    finally:
+        proc.kill()
+
+def test_status(tmp_path):
+    path = tmp_path.joinpath('d.sock')
+    proc = start(path)
+
+    try:
+        reply = request(path, {'command': 'status'})
+
+        assert reply['status'] == 'ok' and reply['pid'] == proc.pid and not reply['busy']
+        assert request(path, {'command': 'unknown'})['status'] == 'error'
+    finally:
+        request(path, {'command': 'stop'})
+        proc.wait(10)
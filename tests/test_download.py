@@ -0,0 +1,104 @@
+import hashlib, threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from manager.download import download
+
+pytest.importorskip('requests')
+
+BODY = bytes(range(256)) * 1000
+SHA256 = hashlib.sha256(BODY).hexdigest()
+
+class Handler(BaseHTTPRequestHandler):
+    body = BODY
+    etag = '"v1"'
+    # Headers of the requests seen
+    requests = []
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.requests.append(dict(self.headers))
+
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+
+        if (rng := self.headers.get('Range')) and self.headers.get('If-Range') == self.etag:
+            start = int(rng[len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(self.body) - 1}/{len(self.body)}')
+        else:
+            self.send_response(200)
+
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.body) - start))
+        self.end_headers()
+        self.wfile.write(self.body[start:])
+
+@pytest.fixture
+def server():
+    Handler.requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/mission.pbo'
+
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_download_and_not_modified(server, tmp_path):
+    dest = tmp_path.joinpath('mission.pbo')
+
+    first = download(server, dest, SHA256)
+
+    assert first.changed and first.sha256 == SHA256
+    assert dest.read_bytes() == BODY
+
+    second = download(server, dest, SHA256)
+
+    assert not second.changed and second.sha256 == SHA256
+    assert Handler.requests[-1].get('If-None-Match') == '"v1"'
+
+def test_resume(server, tmp_path):
+    dest = tmp_path.joinpath('mission.pbo')
+    download(server, dest)
+
+    # An interrupted transfer: the meta file is left incomplete with a partial file
+    dest.unlink()
+    dest.with_name('mission.pbo.part').write_bytes(BODY[:1000])
+    meta = dest.with_name('mission.pbo.json')
+    meta.write_text(meta.read_text().replace('"complete": true', '"complete": false'))
+
+    result = download(server, dest, SHA256)
+
+    assert result.changed and dest.read_bytes() == BODY
+    assert Handler.requests[-1].get('Range') == 'bytes=1000-'
+
+def test_changed_upstream_restarts(server, tmp_path):
+    dest = tmp_path.joinpath('mission.pbo')
+    download(server, dest)
+
+    dest.unlink()
+    dest.with_name('mission.pbo.part').write_bytes(b'stale bytes')
+    meta = dest.with_name('mission.pbo.json')
+    meta.write_text(meta.read_text().replace('"complete": true', '"complete": false').replace('v1', 'v0'))
+
+    assert download(server, dest, SHA256).changed
+    assert dest.read_bytes() == BODY
+
+def test_checksum_mismatch(server, tmp_path):
+    dest = tmp_path.joinpath('mission.pbo')
+
+    with pytest.raises(Exception, match='Checksum mismatch'):
+        download(server, dest, '0' * 64)
+
+    assert not dest.exists()
+    assert not dest.with_name('mission.pbo.part').exists()
@@ -0,0 +1,56 @@
+import pytest
+
+from manager import pbo
+from manager.builder import PBOPacker, StreamingPBOPacker
+
+from conftest import read_pbo
+
+FILES = {
+    'mission.sqm': 'version=53;\n' * 200,
+    'description.ext': 'onLoadName = "Test";\n',
+    'functions/fn_Init.sqf': 'diag_log "init";\n' * 50,
+    'functions/sub/fn_b.sqf': 'b\n',
+    'Data/image.paa': 'not really an image',
+    'empty.txt': ''
+}
+
+def test_stored_output_matches_pbopacker(tree, tmp_path):
+    pytest.importorskip('pboutil')
+
+    src = tree(FILES)
+
+    reference = PBOPacker(src, tmp_path.joinpath('reference.pbo')).binarize()
+    streamed = StreamingPBOPacker(src, tmp_path.joinpath('streamed.pbo')).binarize()
+
+    assert streamed.read_bytes() == reference.read_bytes()
+
+def test_file_map_matches_directory(tree, tmp_path):
+    src = tree(FILES)
+    files = pbo.files_from_directory(src)
+
+    from_dir = StreamingPBOPacker(src, tmp_path.joinpath('dir.pbo')).binarize()
+    from_map = StreamingPBOPacker(None, tmp_path.joinpath('map.pbo'), files=files).binarize()
+
+    assert from_map.read_bytes() == from_dir.read_bytes()
+
+def test_compressed_roundtrip(tree, tmp_path):
+    src = tree(FILES)
+    out = StreamingPBOPacker(src, tmp_path.joinpath('out.pbo'), compress=True, jobs=2).binarize()
+
+    with open(out, 'rb') as fp:
+        headers, _ = pbo.read_headers(fp)
+
+    methods = {x.name: x.method for x in headers}
+
+    assert methods['mission.sqm'] == pbo.METHOD_COMPRESSED
+    # Not in pbo.COMPRESSIBLE
+    assert methods['Data\\image.paa'] == pbo.METHOD_STORED
+
+    contents = read_pbo(out)
+
+    for name, text in FILES.items():
+        assert contents[name.replace('/', '\\')] == text.encode('ascii')
+
+@pytest.mark.parametrize('data', [b'', b'a', b'abcabcabcabc' * 100, bytes(range(256)) * 20])
+def test_lzss_roundtrip(data):
+    assert pbo.lzss_decompress(pbo.lzss_compress(data), len(data)) == data
@@ -0,0 +1,116 @@
+import os, sys, time, signal, asyncio
+
+import pytest
+
+from manager.supervisor import InstanceSpec, Supervisor
+
+# Stands in for arma3server: records each start, then does what it is told
+DUMMY = '''
+import sys, time, signal
+open(sys.argv[1], 'a').write('started %f\\n' % time.time())
+if sys.argv[2] == 'stubborn':
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    open(sys.argv[1], 'a').write('ignoring\\n')
+if sys.argv[2] == 'fail':
+    sys.exit(1)
+if sys.argv[2] == 'ok':
+    sys.exit(0)
+time.sleep(60)
+'''
+
+def spec(tmp_path, name: str, mode: str) -> InstanceSpec:
+    return InstanceSpec(name, [sys.executable, '-c', DUMMY, os.fspath(tmp_path.joinpath(name)), mode])
+
+def lines(tmp_path, name: str) -> list:
+    path = tmp_path.joinpath(name)
+
+    return path.read_text().splitlines() if path.exists() else []
+
+async def until(condition, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        await asyncio.sleep(0.02)
+
+def run(supervisor: Supervisor, condition=None, stop=None) -> float:
+    """ Run `supervisor`, stopping it once `condition` holds. Returns how long stopping took. """
+    async def main() -> float:
+        task = asyncio.ensure_future(supervisor.run())
+
+        if condition is None:
+            await asyncio.wait_for(task, 10)
+            return 0
+
+        await until(condition)
+        start = time.monotonic()
+        (stop or supervisor.stop)()
+        await asyncio.wait_for(task, 10)
+
+        return time.monotonic() - start
+
+    return asyncio.run(main())
+
+def test_restarts_with_backoff(tmp_path):
+    supervisor = Supervisor([spec(tmp_path, 'server', 'fail')], backoff=0.05, max_backoff=0.2)
+    run(supervisor, lambda: len(lines(tmp_path, 'server')) >= 5)
+
+    starts = [float(x.split()[1]) for x in lines(tmp_path, 'server')]
+    gaps = [b - a for a, b in zip(starts, starts[1:])]
+
+    # Doubling up to max_backoff
+    for gap, delay in zip(gaps, [0.05, 0.1, 0.2, 0.2]):
+        assert gap >= delay
+
+@pytest.mark.parametrize('policy', ['on-failure', 'never'])
+def test_clean_exit_is_not_restarted(tmp_path, policy):
+    supervisor = Supervisor([spec(tmp_path, 'server', 'ok')], policy=policy, backoff=0.05)
+    run(supervisor)
+
+    assert len(lines(tmp_path, 'server')) == 1
+    assert supervisor.restarts['server'] == 0
+
+def test_always_restarts_clean_exits(tmp_path):
+    supervisor = Supervisor([spec(tmp_path, 'server', 'ok')], policy='always', backoff=0.05)
+    run(supervisor, lambda: supervisor.restarts['server'] >= 2)
+
+    assert len(lines(tmp_path, 'server')) >= 2
+
+def test_stop_terminates_every_instance(tmp_path):
+    specs = [spec(tmp_path, 'server', 'sleep'), spec(tmp_path, 'hc', 'sleep')]
+    supervisor = Supervisor(specs, stop_timeout=10)
+    processes = []
+
+    def started() -> bool:
+        processes[:] = list(supervisor.processes.values())
+
+        return all(lines(tmp_path, x.name) for x in specs)
+
+    elapsed = run(supervisor, started)
+
+    assert elapsed < 5
+    assert len(processes) == 2 and all(x.returncode is not None for x in processes)
+    assert not supervisor.processes
+    assert all(len(lines(tmp_path, x.name)) == 1 for x in specs)
+
+def test_stubborn_instance_is_killed(tmp_path):
+    supervisor = Supervisor([spec(tmp_path, 'server', 'stubborn')], stop_timeout=0.3)
+    processes = []
+
+    def ignoring() -> bool:
+        processes[:] = list(supervisor.processes.values())
+
+        return 'ignoring' in lines(tmp_path, 'server')
+
+    elapsed = run(supervisor, ignoring)
+
+    assert 0.3 <= elapsed < 5
+    assert processes[0].returncode == -signal.SIGKILL
+
+@pytest.mark.skipif(os.name != 'posix', reason='loop signal handlers')
+def test_sigterm_stops(tmp_path):
+    supervisor = Supervisor([spec(tmp_path, 'server', 'sleep')])
+    elapsed = run(supervisor, lambda: lines(tmp_path, 'server'), lambda: os.kill(os.getpid(), signal.SIGTERM))
+
+    assert elapsed < 5
+    assert not supervisor.processes